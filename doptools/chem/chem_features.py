@@ -28,6 +28,7 @@ from rdkit.Avalon import pyAvalonTools
 #from mordred import Calculator, descriptors
 from doptools.chem.utils import _add_stereo_substructure
 from functools import partialmethod
+import multiprocessing as mp
 
 from rdkit import RDLogger
 RDLogger.DisableLog('rdApp.*')
@@ -74,7 +75,30 @@ class DescriptorCalculator:
         Returns the list of features as strings.
         """
         return self.feature_names
-    
+
+    def get_unseen_fragments(self, X: Iterable, n_jobs: int = 1) -> List[List[str]]:
+        """
+        Returns, for each molecule/CGR in X, the list of its fragments that
+        are not among the features of the fitted calculator. The fragments
+        of each molecule are enumerated once and checked against a frozen
+        set of the training features, the calculator itself is not changed.
+        For calculators that do not enumerate fragments (e.g., fingerprints)
+        all features are always known, so the lists are empty.
+
+        :param X: the array/list/... of molecules/CGRs to check.
+        :type X: array-like, [MoleculeContainers, CGRContainers]
+
+        :param n_jobs: number of processes used for the enumeration.
+        :type n_jobs: int
+        """
+        if not hasattr(self, "_fragments"):
+            return [[] for _ in X]
+        known = frozenset(self.get_feature_names())
+        if n_jobs > 1:
+            with mp.Pool(processes=n_jobs, initializer=_init_unseen_worker, initargs=(self, known)) as pool:
+                return pool.map(_unseen_worker, X, chunksize=max(1, len(X)//(4*n_jobs)))
+        return [_unseen_in(self, known, x) for x in X]
+
 
 class ChythonCircus(DescriptorCalculator, BaseEstimator, TransformerMixin):
     """
@@ -163,54 +187,44 @@ class ChythonCircus(DescriptorCalculator, BaseEstimator, TransformerMixin):
         :type y: None
         """
         self.feature_names = []
-        for i, mol in enumerate(X):
-            reac = None
-            if self.fmt == "smiles":
-                mol = smiles(mol)
-            if isinstance(mol, ReactionContainer):
-                reac = mol
-                mol = reac.compose()
-            for length in range(self.lower, self.upper+1):
-                if not self.on_bond:
-                    for atom in mol._atoms:
-                        # deep is the radius of the neighborhood sphere in bonds
-                        sub = mol.augmented_substructure([atom], deep=length)
-                        sub_smiles = str(sub)
-                        if self.keep_stereo=='yes' and isinstance(mol, CGRContainer):
-                            sub_smiles = _add_stereo_substructure(sub, reac)
-                        if sub_smiles not in self.feature_names:
-                            # if dynamic_only is on, skip all non-dynamic fragments
-                            if self.only_dynamic and ">" not in sub_smiles:
-                                continue
-                            self.feature_names.append(sub_smiles)
-                        if self.keep_stereo=='both' and isinstance(mol, CGRContainer):
-                            sub_smiles = _add_stereo_substructure(sub, reac)
-                            if sub_smiles not in self.feature_names:
-                            # if dynamic_only is on, skip all non-dynamic fragments
-                                if self.only_dynamic and ">" not in sub_smiles:
-                                    continue
-                                self.feature_names.append(sub_smiles)
-                else:
-                    for bond in mol.bonds():
-                        # deep is the radius of the neighborhood sphere in bonds
-                        sub = mol.augmented_substructure([bond[0], bond[1]], deep=length)
-                        sub_smiles = str(sub)
-                        if self.keep_stereo=='yes' and isinstance(mol, CGRContainer):
-                            sub_smiles = _add_stereo_substructure(sub, reac)
-                        if sub_smiles not in self.feature_names:
-                            # if dynamic_only is on, skip all non-dynamic fragments
-                            if self.only_dynamic and ">" not in sub_smiles:
-                                continue
-                            self.feature_names.append(sub_smiles)
-                        if self.keep_stereo=='both' and isinstance(mol, CGRContainer):
-                            sub_smiles = _add_stereo_substructure(sub, reac)
-                            if sub_smiles not in self.feature_names:
-                            # if dynamic_only is on, skip all non-dynamic fragments
-                                if self.only_dynamic and ">" not in sub_smiles:
-                                    continue
-                                self.feature_names.append(sub_smiles)
+        seen = set()
+        for mol in X:
+            for sub_smiles in self._fragments(mol):
+                if sub_smiles not in seen:
+                    seen.add(sub_smiles)
+                    self.feature_names.append(sub_smiles)
         return self
 
+    def _fragments(self, mol):
+        """
+        Enumerates the fragments of one molecule/CGR in the order in which
+        they are added to the features during fitting.
+        """
+        reac = None
+        if self.fmt == "smiles":
+            mol = smiles(mol)
+        if isinstance(mol, ReactionContainer):
+            reac = mol
+            mol = reac.compose()
+        for length in range(self.lower, self.upper+1):
+            if not self.on_bond:
+                centers = [[atom] for atom in mol._atoms]
+            else:
+                centers = [[bond[0], bond[1]] for bond in mol.bonds()]
+            for center in centers:
+                # deep is the radius of the neighborhood sphere in bonds
+                sub = mol.augmented_substructure(center, deep=length)
+                sub_smiles = str(sub)
+                if self.keep_stereo=='yes' and isinstance(mol, CGRContainer):
+                    sub_smiles = _add_stereo_substructure(sub, reac)
+                # if dynamic_only is on, skip all non-dynamic fragments
+                if not (self.only_dynamic and ">" not in sub_smiles):
+                    yield sub_smiles
+                if self.keep_stereo=='both' and isinstance(mol, CGRContainer):
+                    sub_smiles = _add_stereo_substructure(sub, reac)
+                    if not (self.only_dynamic and ">" not in sub_smiles):
+                        yield sub_smiles
+
     def transform(self, X: Iterable, y: Optional[List] = None) -> DataFrame:
         """
         Transforms the given array of molecules/CGRs to a data frame
@@ -329,6 +343,16 @@ class ChythonLinear(DescriptorCalculator, BaseEstimator, TransformerMixin):
         self.feature_names = pd.DataFrame(output).columns
         return self
 
+    def _fragments(self, mol):
+        """
+        Enumerates the fragments of one molecule/CGR.
+        """
+        if self.fmt == "smiles":
+            mol = smiles(mol)
+        if isinstance(mol, ReactionContainer):
+            mol = mol.compose()
+        return mol.linear_smiles_hash(self.lower, self.upper, number_bit_pairs=0).keys()
+
     def transform(self, X: DataFrame, y: Optional[List] = None):
         """
         Transforms the given array of molecules/CGRs to a data frame
@@ -644,6 +668,28 @@ class ComplexFragmentor(DescriptorCalculator, BaseEstimator, TransformerMixin):
         res.columns = self.feature_names
         return res
 
+    def get_unseen_fragments(self, x: DataFrame, n_jobs: int = 1) -> List[List[str]]:
+        """
+        Returns, for each row of the data frame, the list of fragments
+        that are not among the features of the fitted calculators. The
+        fragments are named as the features, i.e., "column::fragment".
+
+        :param x: the data frame with the columns indicated in the associator.
+        :type x: DataFrame
+
+        :param n_jobs: number of processes used for the enumeration.
+        :type n_jobs: int
+        """
+        if not isinstance(x, DataFrame):
+            x = pd.DataFrame(x if isinstance(x, list) else [x])
+        res = [[] for _ in range(len(x))]
+        for k, v in self.associator:
+            if k == "numerical" or not hasattr(v, "get_unseen_fragments"):
+                continue
+            for i, unseen in enumerate(v.get_unseen_fragments(list(x[k]), n_jobs=n_jobs)):
+                res[i] += [k+'::'+f for f in unseen]
+        return res
+
 
 # class Mordred2DCalculator(DescriptorCalculator, BaseEstimator, TransformerMixin):
 #     """
@@ -812,6 +858,27 @@ class ChythonCircusNonhash(BaseEstimator, TransformerMixin):
                         self.features.append(sub)
         return self
 
+    def _fragments(self, mol):
+        """
+        Enumerates the fragments (as strings) of one molecule/CGR, as they
+        are found during fitting.
+        """
+        if self.fmt == "smiles":
+            mol = smiles(mol)
+        for length in range(self.lower, self.upper+1):
+            for atom in mol.atoms():
+                sub_smiles = str(mol.augmented_substructure([atom[0]], deep=length))
+                if not (self.only_dynamic and ">" not in sub_smiles):
+                    yield sub_smiles
+
+    def get_unseen_fragments(self, X: Iterable, n_jobs: int = 1) -> List[List[str]]:
+        """
+        Returns, for each molecule/CGR in X, the list of its fragments that
+        are not among the features of the fitted calculator. See
+        DescriptorCalculator.get_unseen_fragments.
+        """
+        return DescriptorCalculator.get_unseen_fragments(self, X, n_jobs)
+
     def transform(self, X: DataFrame, y: Optional[List] = None) -> DataFrame:
         """
         Transforms the given array of molecules/CGRs to a data frame
@@ -841,5 +908,22 @@ class ChythonCircusNonhash(BaseEstimator, TransformerMixin):
         return self.feature_names
 
 
+def _unseen_in(calculator, known, x):
+    return [f for f in dict.fromkeys(calculator._fragments(x)) if f not in known]
+
+
+_unseen_calculator = None
+_unseen_known = None
+
+
+def _init_unseen_worker(calculator, known):
+    global _unseen_calculator, _unseen_known
+    _unseen_calculator, _unseen_known = calculator, known
+
+
+def _unseen_worker(x):
+    return _unseen_in(_unseen_calculator, _unseen_known, x)
+
+
 __all__ = ['ChythonCircus', 'ChythonCircusNonhash', 'ChythonLinear', 'ComplexFragmentor',
            'DescriptorCalculator', 'Fingerprinter', 'PassThrough']
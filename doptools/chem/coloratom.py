@@ -27,6 +27,9 @@ from IPython.display import HTML
 from matplotlib.cm import RdYlGn, PiYG, Blues
 from matplotlib.colors import rgb2hex
 import itertools
+import os
+import multiprocessing as mp
+from collections import OrderedDict
 from io import StringIO
 from typing import List, Dict
 from pandas import DataFrame, Series
@@ -492,5 +495,392 @@ class ColorAtom:
                 uni = uni.union(mols[i], remap=True)
             return uni
 
-            
-__all__ = ['ColorAtom']
+
+
+class ColorAtomRenderer:
+    """
+    ColorAtomRenderer is a headless batch renderer for the images produced by ColorAtom. It is meant
+    for reports on large sets of molecules, where the depiction and the colorbar generation in
+    output_html become the bottleneck.
+
+    The 2D layout of every molecule is calculated only once and the resulting base SVG is kept in
+    a bounded cache, so the same molecule can be redrawn with other limits without new depiction.
+    The colorbar is not drawn by matplotlib for each image, but generated from an SVG template
+    (the gradient is sampled from the colormap once) in which only the limits and the size change.
+
+    The images can be written as separate SVG files or as one HTML report. In both cases the
+    molecules are processed in a streaming fashion, optionally by a pool of worker processes, and
+    only the images of one chunk are kept in memory at the same time.
+    """
+    def __init__(self, coloratom: ColorAtom, colorbar: bool = True, external_limits: List = None,
+                 nticks: int = 5, n_jobs: int = 1, chunksize: int = 16, cache_size: int = 1024):
+        """
+        ColorAtomRenderer constructor.
+
+        Parameters
+        ----------
+        coloratom : ColorAtom
+            ColorAtom object with the pipeline already set
+
+        colorbar : bool [optional]
+            If True, the colorbar is added to each image
+
+        external_limits : list [optional]
+            If given in the format [min, max], it will be used as limits for the color scale
+            of all images, which makes the colors comparable between molecules.
+
+        nticks : int [optional]
+            Number of ticks on the colorbar
+
+        n_jobs : int [optional]
+            Number of worker processes used to calculate contributions and draw images
+
+        chunksize : int [optional]
+            Number of molecules sent to a worker process at once
+
+        cache_size : int [optional]
+            Maximum number of depicted molecules kept in the cache
+        """
+        self.coloratom = coloratom
+        self.colorbar = colorbar
+        self.external_limits = external_limits
+        self.nticks = nticks
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+        self.cache_size = cache_size
+        self._depictions = OrderedDict()
+        self._gradient = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_depictions'] = OrderedDict()
+        return state
+
+    def render(self, mol, contributions: Dict = None) -> List[str]:
+        """Generates the SVG images of atomic contributions for the given molecule (Series if
+        the fragmentor is complex), the same way as ColorAtom.output_html does.
+
+        Parameters
+        ----------
+        mol : [MoleculeContainer,CGRContainer,ReactionContainer,Series]
+            the molecule for which the images will be generated
+
+        contributions: Dict [optional]
+            If previously calculated by calculate_atom_contributions and given,
+            the contribution of the molecule will not be recalculated.
+
+        Returns
+        -------
+        svgs: List[str]
+            SVG code of each structure, followed by the colorbar if it is required
+        """
+        if contributions is None:
+            contributions = self.coloratom.calculate_atom_contributions(mol)
+        if self.external_limits is not None:
+            min_value, max_value = self.external_limits
+        else:
+            values = [v for cc in contributions.values() for v in cc.values()]
+            min_value, max_value = np.min(values), np.max(values)
+
+        if self.coloratom.complex:
+            structures = [mol[c] for c in self.coloratom.structure_cols]
+        else:
+            structures = [mol]
+
+        svgs = []
+        for m in structures:
+            svgs.append(self._draw_structure(m, contributions[m], min_value, max_value))
+        if self.colorbar:
+            height = float(svgs[-1].split('"')[3][:-2])
+            svgs.append(self.colorbar_svg(min_value, max_value, width=height/8+1.01, height=height))
+        return svgs
+
+    def colorbar_svg(self, min_value: float, max_value: float, width: float, height: float,
+                     orient: str = 'vertical') -> str:
+        """Generates the colorbar from the SVG template. The layout follows the one of
+        ColorAtom._colorbar_to_svg, but no matplotlib figure is created.
+
+        Parameters
+        ----------
+        min_value, max_value : float
+            limits of the color scale
+
+        width, height : float
+            size of the colorbar in cm, as in ColorAtom._colorbar_to_svg
+
+        orient : str [optional]
+            'vertical' or 'horizontal'
+
+        Returns
+        -------
+        svg: str
+            SVG code of the colorbar
+        """
+        if self._gradient is None:
+            self._gradient = ''.join(['<stop offset="{:.3f}" stop-color="{}" />'.format(p, rgb2hex(self.coloratom.colormap(p)))
+                                      for p in np.linspace(0, 1, 33)])
+        if self.coloratom.model_type != "C":
+            max_value = max(np.abs(min_value), np.abs(max_value))
+            min_value = -max_value
+        ticks = np.linspace(min_value, max_value, self.nticks)
+        # the size of the matplotlib version is (width, height/2) in cm, the drawing is done in points
+        w, h = width*72/2.54, height*72/2.54/2
+        if orient == 'vertical':
+            x0, y0, bw, bh = 0.05*w, 0.05*h, 0.15*w, 0.80*h
+            gradient = 'x1="0" y1="1" x2="0" y2="0"'
+            positions = [(x0+bw, y0+bh*(1-i/(self.nticks-1))) for i in range(self.nticks)]
+            tick_line = '<line x1="{0:.2f}" y1="{1:.2f}" x2="{2:.2f}" y2="{1:.2f}" stroke="black" stroke-width="0.8" />'
+            tick_text = '<text x="{:.2f}" y="{:.2f}" dominant-baseline="middle">{}</text>'
+            tick_shift = (3.5, 0), (6, 0)
+        else:
+            x0, y0, bw, bh = 0.05*w, 0.05*h, 0.80*w, 0.45*h
+            gradient = 'x1="0" y1="0" x2="1" y2="0"'
+            positions = [(x0+bw*i/(self.nticks-1), y0+bh) for i in range(self.nticks)]
+            tick_line = '<line x1="{0:.2f}" y1="{1:.2f}" x2="{0:.2f}" y2="{3:.2f}" stroke="black" stroke-width="0.8" />'
+            tick_text = '<text x="{:.2f}" y="{:.2f}" text-anchor="middle" dominant-baseline="hanging">{}</text>'
+            tick_shift = (0, 3.5), (0, 6)
+
+        svg = ['<svg style="background-color:white" width="{:.2f}cm" height="{:.2f}cm" viewBox="0 0 {:.2f} {:.2f}" '
+               'xmlns="http://www.w3.org/2000/svg" version="1.1">'.format(width, height/2, w, h),
+               '<defs><linearGradient id="colorbar-gradient" {}>{}</linearGradient></defs>'.format(gradient, self._gradient),
+               '<rect x="{:.2f}" y="{:.2f}" width="{:.2f}" height="{:.2f}" fill="url(#colorbar-gradient)" '
+               'stroke="black" stroke-width="0.8" />'.format(x0, y0, bw, bh),
+               '<g font-family="sans-serif" font-size="8">']
+        for (x, y), t in zip(positions, ticks):
+            svg.append(tick_line.format(x, y, x+tick_shift[0][0], y+tick_shift[0][1]))
+            svg.append(tick_text.format(x+tick_shift[1][0], y+tick_shift[1][1], '{:.3g}'.format(t)))
+        svg.append('</g></svg>')
+        return ''.join(svg)
+
+    def iter_svgs(self, mols):
+        """Generator that renders the given molecules (DataFrame rows if the fragmentor is complex)
+        and yields the lists of SVG images in the order of the input. If n_jobs is larger than 1,
+        the molecules are processed in a pool of worker processes.
+        """
+        if isinstance(mols, DataFrame):
+            mols = (row for _, row in mols.iterrows())
+        if self.n_jobs > 1:
+            with mp.Pool(processes=self.n_jobs, initializer=_init_render_worker, initargs=(self,)) as pool:
+                yield from pool.imap(_render_worker, mols, chunksize=self.chunksize)
+        else:
+            for m in mols:
+                yield self.render(m)
+
+    def write_svgs(self, mols, outdir: str, prefix: str = "mol") -> int:
+        """Renders the given molecules and writes each image into a separate SVG file
+        in the output folder. The files are named as [prefix][molecule number].[image number].svg
+
+        Returns
+        -------
+        count: int
+            number of processed molecules
+        """
+        os.makedirs(outdir, exist_ok=True)
+        count = 0
+        for i, svgs in enumerate(self.iter_svgs(mols)):
+            for j, svg in enumerate(svgs):
+                with open(os.path.join(outdir, '{}{}.{}.svg'.format(prefix, i+1, j+1)), 'w') as f:
+                    f.write(svg)
+            count += 1
+        return count
+
+    def write_html(self, mols, filename: str, title: str = "ColorAtom") -> int:
+        """Renders the given molecules and writes them into one HTML report, one line per
+        molecule. The report is written progressively, so the images are not kept in memory.
+
+        Returns
+        -------
+        count: int
+            number of processed molecules
+        """
+        count = 0
+        with open(filename, 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{}</title></head><body>\n'.format(title))
+            for svgs in self.iter_svgs(mols):
+                f.write('<div style="white-space: nowrap; align-items: middle">'+''.join(svgs)+'</div>\n')
+                count += 1
+            f.write('</body></html>\n')
+        return count
+
+    def _depict(self, m):
+        key = id(m)
+        if key in self._depictions:
+            self._depictions.move_to_end(key)
+            return self._depictions[key][1:]
+        drawn = m
+        if isinstance(m, ReactionContainer):
+            if self.coloratom.reaction == "reactants":
+                drawn = self.coloratom._unite_mol_list(m.reactants)
+            elif self.coloratom.reaction == "products":
+                drawn = self.coloratom._unite_mol_list(m.products)
+        ext_svg = drawn.depict()[:-6]
+        ext_svg = '<svg style="background-color:white" '+ext_svg[4:]
+        positions = {}
+        for k, a in drawn.atoms():
+            x, y = a.x, -a.y
+            if len(a.atomic_symbol) > 1:
+                x -= 0.1
+            positions[k] = (x, y)
+        # the molecule itself is stored to keep its id reserved while it is in the cache
+        self._depictions[key] = (m, ext_svg, positions)
+        if len(self._depictions) > self.cache_size:
+            self._depictions.popitem(last=False)
+        return ext_svg, positions
+
+    def _draw_structure(self, m, contr: Dict, min_value: float, max_value: float) -> str:
+        ext_svg, positions = self._depict(m)
+        atoms = [k for k in contr.keys() if k in positions]
+        values = np.array([contr[k] for k in atoms], dtype=float)
+        if self.coloratom.model_type == "C":
+            scale = max_value - min_value
+            values = (values - min_value)/scale if scale else np.zeros(len(values))
+        else:
+            scale = max(np.abs([min_value, max_value]))
+            values = (values + scale)/2./scale if scale else np.full(len(values), 0.5)
+        colors = self.coloratom.colormap(values)
+        circles = ['<circle cx="{}" cy="{}" r="0.33" stroke="{}" stroke-width="0.1" fill="none" />'.format(
+                   *positions[k], rgb2hex(c)) for k, c in zip(atoms, colors)]
+        return ext_svg + ''.join(circles) + "</svg>"
+
+
+
+class ContributionStatistics:
+    """
+    ContributionStatistics aggregates the atomic contributions calculated by ColorAtom over a
+    whole set of molecules. Each atom contribution is assigned to the environment of the atom -
+    the augmented substructure of the given radius around it, as in CircuS fragments - and the
+    running count, mean and variance of the contributions are accumulated for every environment
+    (Welford's algorithm). The memory is therefore constant per fragment, independently of the
+    number of molecules, and the whole data set is processed in one pass.
+
+    The statistics of several aggregators (e.g., calculated in parallel on parts of the set)
+    can be combined with the merge method.
+    """
+    def __init__(self, radius: int = 1):
+        """
+        ContributionStatistics constructor.
+
+        Parameters
+        ----------
+        radius : int [optional]
+            radius of the atom environment used as a key of the statistics, 1 by default
+        """
+        self.radius = radius
+        self.n_molecules = 0
+        self._stats = {}
+
+    def update(self, contributions):
+        """Adds the contributions of a molecule or a batch of molecules to the statistics.
+
+        Parameters
+        ----------
+        contributions : Dict or List[Dict]
+            output of ColorAtom.calculate_atom_contributions, or a list of such outputs
+
+        Returns
+        -------
+        self
+        """
+        if isinstance(contributions, dict):
+            contributions = [contributions]
+        for contr in contributions:
+            for mol, weights in contr.items():
+                environments = self._environments(mol)
+                for atom, w in weights.items():
+                    if atom not in environments:
+                        continue
+                    self._add(environments[atom], 1, float(w), 0.)
+            self.n_molecules += 1
+        return self
+
+    def consume(self, coloratom: ColorAtom, mols):
+        """Calculates the contributions for each of the given molecules (DataFrame rows if the
+        fragmentor is complex) with the ColorAtom object and adds them to the statistics.
+        The contributions are not stored.
+
+        Returns
+        -------
+        self
+        """
+        if isinstance(mols, DataFrame):
+            mols = (row for _, row in mols.iterrows())
+        for m in mols:
+            self.update(coloratom.calculate_atom_contributions(m))
+        return self
+
+    def merge(self, other: 'ContributionStatistics'):
+        """Combines the statistics of another aggregator with the same radius into this one.
+
+        Returns
+        -------
+        self
+        """
+        if other.radius != self.radius:
+            raise ValueError("Cannot merge statistics calculated with different radius")
+        for key, (count, mean, m2) in other._stats.items():
+            self._add(key, count, mean, m2)
+        self.n_molecules += other.n_molecules
+        return self
+
+    def summary(self, min_count: int = 1) -> DataFrame:
+        """Returns the statistics as a data frame with one row per fragment, ranked by the
+        absolute value of the mean contribution.
+
+        Parameters
+        ----------
+        min_count : int [optional]
+            fragments that were found fewer times are not reported
+
+        Returns
+        -------
+        summary: DataFrame
+            columns "fragment", "count", "mean", "std" and "abs_mean"
+        """
+        keys = [k for k, v in self._stats.items() if v[0] >= min_count]
+        values = np.array([self._stats[k] for k in keys], dtype=float).reshape(-1, 3)
+        count, mean, m2 = values[:, 0], values[:, 1], values[:, 2]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            std = np.where(count > 1, np.sqrt(m2/(count-1)), 0.)
+        res = pd.DataFrame({"fragment": keys, "count": count.astype(int), "mean": mean,
+                            "std": std, "abs_mean": np.abs(mean)})
+        return res.sort_values(by="abs_mean", ascending=False).reset_index(drop=True)
+
+    def ranking(self, top: int = None, min_count: int = 1) -> List:
+        """Returns the list of fragments ranked by the absolute value of the mean contribution.
+        If top is given, only the first top fragments are returned.
+        """
+        ranked = list(self.summary(min_count)["fragment"])
+        return ranked if top is None else ranked[:top]
+
+    def _add(self, key, count, mean, m2):
+        # parallel variant of Welford's update (Chan et al.), also valid for count=1, m2=0
+        if key not in self._stats:
+            self._stats[key] = [count, mean, m2]
+            return
+        stat = self._stats[key]
+        total = stat[0] + count
+        delta = mean - stat[1]
+        stat[1] += delta*count/total
+        stat[2] += m2 + delta*delta*stat[0]*count/total
+        stat[0] = total
+
+    def _environments(self, mol):
+        if isinstance(mol, ReactionContainer):
+            mol = mol.compose()
+        return {a: str(mol.augmented_substructure([a], deep=self.radius)) for a in mol._atoms}
+
+
+_worker_renderer = None
+
+
+def _init_render_worker(renderer):
+    global _worker_renderer
+    DEPICT.depict_settings(monochrome=True, aam=False)
+    _worker_renderer = renderer
+
+
+def _render_worker(mol):
+    return _worker_renderer.render(mol)
+
+
+__all__ = ['ColorAtom', 'ColorAtomRenderer', 'ContributionStatistics']
@@ -13,17 +13,17 @@ import pandas as pd
 
 from chython import smiles
 from doptools.chem.chem_features import ChythonCircus, ChythonLinear
+from doptools.optimizer.utils import load_descriptor_file
 from functools import partial
 from multiprocessing import Manager
 from sklearn.base import TransformerMixin, BaseEstimator
-from sklearn.datasets import load_svmlight_file
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
 from sklearn.feature_selection import VarianceThreshold
 from sklearn.metrics import (balanced_accuracy_score, cohen_kappa_score,
                              matthews_corrcoef, r2_score as r2,
                              root_mean_squared_error as rmse)
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import FunctionTransformer, MinMaxScaler
+from sklearn.preprocessing import FunctionTransformer, MaxAbsScaler, MinMaxScaler
 from sklearn.svm import SVC, SVR
 from xgboost import XGBRegressor, XGBClassifier
 
@@ -37,8 +37,9 @@ def populate_trials_dictionary(trials_folders):
         trials_folders (list): List of folders where 'trials.best' files are stored.
 
     Returns:
-        dict: A dictionary where each key is a 'method' from 'trials.best' files,
-              and the value is a dictionary containing the path to 'trials.best' and the folder path.
+        dict: A dictionary where each key is a 'method' from 'trials.best' files (a file of a study
+              optimizing several methods gives several keys), and the value is a dictionary containing
+              the path to 'trials.best' and the folder path.
     """
     trials_dict = {}
     processed_folders = set()
@@ -54,14 +55,14 @@ def populate_trials_dictionary(trials_folders):
         if os.path.isfile(trials_file):
             df = pd.read_csv(trials_file, sep='\s+')
             if 'method' in df.columns:
-                method_value = df['method'].iloc[0]
-                if method_value in trials_dict:
-                    logging.critical(f"Duplicate method detected: {method_value} in {trials_file}")
-                    sys.exit(1)  # Exit due to duplicate method entry
-                trials_dict[method_value] = {
-                    'trials_file': trials_file,
-                    'trials_folder': folder
-                }
+                for method_value in df['method'].unique():
+                    if method_value in trials_dict:
+                        logging.critical(f"Duplicate method detected: {method_value} in {trials_file}")
+                        sys.exit(1)  # Exit due to duplicate method entry
+                    trials_dict[method_value] = {
+                        'trials_file': trials_file,
+                        'trials_folder': folder
+                    }
             else:
                 logging.critical(f"'method' column not found in {trials_file}")
                 sys.exit(1)
@@ -123,6 +124,7 @@ def select_best_CV_models(trials_info_dict, model_type, nb_classes):
                 file.writelines(corrected_lines)
 
         model_stats = pd.read_csv(trials_file, sep='\s+')
+        model_stats = model_stats[model_stats['method'] == method]
         highest_score = max(highest_score, model_stats['score'].max())
         # Per each descriptor space only one (the best) descriptor space is selected.
         for desc, group in model_stats.groupby('desc'):
@@ -163,12 +165,15 @@ def create_model_folder(desc_folder, outdir, models_from_CV, input_df, test_set_
     input_df.to_csv(os.path.join(outdir, 'training_set.csv'), index=False)
     if test_set_df is not None and not test_set_df.empty:
         test_set_df.to_csv(os.path.join(outdir, 'external_test_set.csv'), index=False)
-    # Iterate through the .svm files in desc_folder and copy relevant files to outdir
-    for file_path in glob.glob(os.path.join(desc_folder, '*.svm')):
+    # Iterate through the .svm files and the .csr folders in desc_folder and copy relevant ones to outdir
+    for file_path in glob.glob(os.path.join(desc_folder, '*.svm')) + glob.glob(os.path.join(desc_folder, '*.csr')):
         file_name = os.path.basename(file_path)
         desc_name = file_name.split('.')[1]
         if desc_name in unique_descs:
-            shutil.copyfile(file_path, os.path.join(outdir, file_name))
+            if os.path.isdir(file_path):
+                shutil.copytree(file_path, os.path.join(outdir, file_name), dirs_exist_ok=True)
+            else:
+                shutil.copyfile(file_path, os.path.join(outdir, file_name))
 
 
 def load_pkl(pkl_file):
@@ -250,7 +255,10 @@ def rebuild_and_evaluate_reg_model(model_row_tuple, shared_data, outdir, desc_fo
 
     # Build the pipeline
     steps = [('Fragmentor', descriptor_object)]
-    if model_row.get('scaling', '') == 'scaled':
+    if model_row.get('scaling', '') == 'maxabs':
+        steps.append(('Scaler', MaxAbsScaler()))
+    elif model_row.get('scaling', '') == 'scaled':
+        # the tables of the previous versions were optimized with min-max scaling
         steps.append(('Scaler', MinMaxScaler()))
     steps.append(('Variance', VarianceThreshold()))
     steps.append(('Model', model))
@@ -353,7 +361,10 @@ def rebuild_model(model_row_tuple, shared_data, outdir, desc_folder, property_co
                 tree_method=str(model_row['tree_method'])
             )
     steps = [('Fragmentor', descriptor_object)]
-    if model_row['scaling'] == 'scaled':
+    if model_row['scaling'] == 'maxabs':
+        steps.append(('Scaler', MaxAbsScaler()))
+    elif model_row['scaling'] == 'scaled':
+        # the tables of the previous versions were optimized with min-max scaling
         steps.append(('Scaler', MinMaxScaler()))
     steps.append(('Variance', VarianceThreshold()))
     # Train the model on the input data
@@ -438,7 +449,7 @@ def evaluate_AD_apply_model(desc_file, shared_molecules):
     train_fragmentor (Fragmentor Object): The pkl file path to the given descriptor space.
     shared_pred_molecules (list): A list of dictionaries, where each dictionary contains the 'SMILES' string
                              and the corresponding 'Molecule' object (chython.containers.molecule.MoleculeContainer).
-    desc_file (str) : File path to the training set descriptors in svm format.
+    desc_file (str) : File path to the training set descriptors in svm format (or the .csr folder).
     pred_descs (np.array): Numpy array containing the descriptors for all the predicting molecules
     model_path (str): File path to model pipeline pkl.
 
@@ -537,7 +548,7 @@ def evaluate_AD_apply_model(desc_file, shared_molecules):
         p_descs_pipeline = model_pipeline[0].transform(shared_predict_df['Molecule'])
         pred_descs = np.array(p_descs_pipeline) # convert the descriptors into np.array for bounding box assessment
         # Load the SVM file into a sparse matrix
-        desc_svm, _ = load_svmlight_file(desc_file)
+        desc_svm, _ = load_descriptor_file(desc_file)
         # Convert the sparse matrix to a dense NumPy array
         train_descs = desc_svm.toarray()
         max_val_descs = np.max(train_descs, axis = 0)
@@ -975,15 +986,18 @@ if __name__ == "__main__":
                 second_func_args = [(_, row) for _, row in best_models.iterrows()]
                 partial_rebuild_model = partial(rebuild_model, **rebuild_kwargs)
                 pool.map(partial_rebuild_model, second_func_args)
-                # At this point the model folder contains up to 15 svm files, however we're retaining only up to 10. Unnecessary svm files are deleted with the code bellow
+                # At this point the model folder contains up to 15 descriptor files (.svm or .csr folders), however we're retaining only up to 10. Unnecessary ones are deleted with the code bellow
                 needed_descriptors = set(best_models['desc'])
                 files_in_directory = os.listdir(model_folder)
-                svm_files = [file for file in files_in_directory if file.endswith('.svm')]
+                svm_files = [file for file in files_in_directory if file.endswith(('.svm', '.csr'))]
                 for svm_file in svm_files:
                     descriptor = svm_file.split('.')[1]
                     if descriptor not in needed_descriptors:
                         file_path = os.path.join(model_folder, svm_file)
-                        os.remove(file_path)
+                        if os.path.isdir(file_path):
+                            shutil.rmtree(file_path)
+                        else:
+                            os.remove(file_path)
             else: # classification task
                 best_models = models_from_CV
                 rebuild_kwargs = {k: v for k, v in kwargs.items() if k != 'predict_df'} # don't need to provide predict_df for the next function.
@@ -998,7 +1012,7 @@ if __name__ == "__main__":
             shared_molecules.extend(test_set_file_data)
             all_results = dict(zip(test_set_df['SMILES'], [{} for _ in range(len(test_set_df['SMILES']))]))
             with mp.Pool(processes=args.parallel if args.parallel > 0 else 1) as pool:
-                for desc_file in glob.glob(model_folder + '/*.svm'):
+                for desc_file in glob.glob(model_folder + '/*.svm') + glob.glob(model_folder + '/*.csr'):
                     result = pool.apply_async(evaluate_AD_apply_model, args=(desc_file, shared_molecules))
                     updated_shared_predict_df = result.get()
                     for _, row in updated_shared_predict_df.iterrows():
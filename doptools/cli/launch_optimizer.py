@@ -22,6 +22,7 @@ import contextlib
 import os
 import warnings
 from functools import partial
+from importlib.util import find_spec
 from multiprocessing import Manager
 
 import optuna
@@ -53,14 +54,43 @@ def launch_optimizer():
     parser.add_argument('--earlystop_leaders', type=int, default=1,
                         help='Number N of best solutions that will be checked for the early stopping. Default = 1.')
     parser.add_argument('--timeout', type=int, default=60,
-                        help='Timeout in sec. If a trial takes longer it will be killed. Default = 60.')
+                        help='Timeout of a trial in sec. It is checked between the cross-validation folds: a trial over the timeout is pruned '
+                             'after its current fold, and killed if it runs for longer than 1.5 times the timeout. '
+                             'The scoring after the last fold is not limited. 0 disables the timeout. Default = 60.')
     
+    parser.add_argument('--pruner', type=str, default='none', choices=['none', 'median', 'halving', 'hyperband'],
+                        help='Pruner that stops unpromising trials by their scores on the first cross-validation folds. By default no pruning is done.')
+
+    parser.add_argument('--storage', type=str, default=None,
+                        help='Storage of the Optuna study: "sqlite" or "journal" for a file in the output directory, or a database URL. '
+                             'The study is named after the output directory and is resumed if it exists in the storage. '
+                             'Several optimizers sharing the storage work on the same study. By default the study is kept in memory.')
+    parser.add_argument('--study_name', type=str, default=None,
+                        help='Name of the Optuna study in the storage. Default = the name of the output directory.')
+
+    parser.add_argument('--parquet', action='store_true',
+                        help='Save the results of all trials in Parquet format (trials.parquet) in addition to trials.all. '
+                             'Requires pyarrow or fastparquet (pip install doptools[parquet]).')
+
+    parser.add_argument('--screen', type=int, default=0,
+                        help='Number of descriptor spaces kept for the optimization after a fast screening of all spaces with a ridge model '
+                             'on a subsample of the data (scores saved in descriptors.screening). By default all spaces are optimized.')
+
+    parser.add_argument('--warm_start', type=str, nargs='+', default=None,
+                        help='trials.all or parameters.json files (or output directories) of previous optimizations. '
+                             'Their best trials are evaluated first in the new study, if they fit its search space.')
+    parser.add_argument('--warm_trials', type=int, default=10,
+                        help='Maximal number of previous trials evaluated first with --warm_start. Default = 10.')
+
     parser.add_argument('-j', '--jobs', type=int, default=1,
                         help='Number of processes that will be launched in parallel during the optimization. Default = 1.')
-    parser.add_argument('-m', '--method', type=str, default='SVR', choices=['SVR', 'SVC', 'RFR', 'RFC', 'XGBR', 'XGBC'],
-                        help='ML algorithm to be used for optimization. Only one can be used at a time.')
+    parser.add_argument('--cv_jobs', type=int, default=1,
+                        help='Number of cross-validation folds that will be trained in parallel within each trial. Default = 1.')
+    parser.add_argument('-m', '--method', type=str, nargs='+', default=['SVR'], choices=['SVR', 'SVC', 'RFR', 'RFC', 'XGBR', 'XGBC'],
+                        help='ML algorithm(s) to be used for optimization. If several are given, they are optimized jointly '
+                             '(the method is selected as a hyperparameter). All methods should be of the same task (R or C).')
     #parser.add_argument('--multi', action='store_true')
-    parser.add_argument('-f', '--format', type=str, default='svm', choices=['svm', 'csv'],
+    parser.add_argument('-f', '--format', type=str, default='svm', choices=['svm', 'csv', 'csr', 'parquet'],
                         help='Format of the input descriptor files. Default = svm.')
     
     args = parser.parse_args()
@@ -71,19 +101,34 @@ def launch_optimizer():
     cv_repeats = args.cv_repeats
     tmout = args.timeout
     jobs = args.jobs
-    method = args.method
+    cv_jobs = args.cv_jobs
+    pruner = args.pruner
+    storage = args.storage
+    study_name = args.study_name
+    parquet = args.parquet
+    screen = args.screen
+    warm_start = args.warm_start
+    warm_trials = args.warm_trials
+    method = args.method[0] if len(args.method) == 1 else args.method
     #multi = args.multi
     fmt = args.format
     earlystop = (args.earlystop_patience, args.earlystop_leaders)
 
+    if len(set(m[-1] for m in args.method)) > 1:
+        parser.error('Regression and classification methods cannot be optimized together')
+    if (parquet or fmt == 'parquet') and find_spec('pyarrow') is None and find_spec('fastparquet') is None:
+        parser.error('Parquet files require pyarrow or fastparquet (pip install doptools[parquet])')
+
     if os.path.exists(outdir):
         print('The output directory {} already exists. The data may be overwritten'.format(outdir))
     else:
         os.makedirs(outdir)
         print('The output directory {} created'.format(outdir))
 
-    x_dict, y = collect_data(datadir, method, fmt)
+    x_dict, y = collect_data(datadir, args.method[0], fmt, n_jobs=jobs)
     
     with contextlib.redirect_stdout(open(os.devnull, "w")):
         launch_study(x_dict, y, outdir, method, ntrials, 
-                     cv_splits, cv_repeats, jobs, tmout, earlystop)
\ No newline at end of file
+                     cv_splits, cv_repeats, jobs, tmout, earlystop, cv_jobs=cv_jobs, pruner=pruner, storage=storage, parquet=parquet,
+                     screen=screen, warm_start=warm_start, warm_trials=warm_trials,
+                     study_name=study_name)
\ No newline at end of file
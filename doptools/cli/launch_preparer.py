@@ -35,6 +35,7 @@ from doptools.chem.chem_features import ComplexFragmentor, PassThrough
 from doptools.chem.solvents import SolventVectorizer
 from doptools.optimizer.config import get_raw_calculator
 from doptools.optimizer.preparer import *
+from doptools.optimizer.utils import save_descriptors
 
 logging.basicConfig(
     format="{asctime} - {levelname} - {message}",
@@ -95,6 +96,10 @@ def _calculate_and_output(input_params):
     if fmt == "csv":
         desc = pd.concat([pd.Series(prop, name=prop_name), desc], axis=1, sort=False)
         desc.to_csv(output_name, index=False)
+    elif fmt == "csr":
+        save_descriptors(output_name, desc, prop,
+                         metadata={'property': prop_name, 'descriptor': calculator.short_name,
+                                   'calculator': type(calculator).__name__})
     else:
         dump_svmlight_file(np.array(desc, dtype="float32"), prop, output_name, zero_based=False)
     
@@ -261,8 +266,8 @@ def launch_preparer():
                         help='Standardize the input structures? Default = False.')
     parser.add_argument('-o', '--output', 
                          help='Output folder where the descriptor files will be saved.')
-    parser.add_argument('-f', '--format', action='store', type=str, default='svm', choices=['svm', 'csv'],
-                        help='Descriptor files format. Default = svm.')
+    parser.add_argument('-f', '--format', action='store', type=str, default='svm', choices=['svm', 'csv', 'csr'],
+                        help='Descriptor files format. csr is a binary format (folder with NumPy arrays), fast to load. Default = svm.')
     parser.add_argument('-p', '--parallel', action='store', type=int, default=0,
                         help='Number of parallel processes to use. Default = 0')
     parser.add_argument('-s', '--save', action='store_true',
@@ -26,9 +26,10 @@ import glob
 from typing import Optional, List, Dict, Tuple, Iterable
 
 from doptools.optimizer.config import get_raw_model
+from doptools.optimizer.utils import _parse_value
 
 from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import MinMaxScaler
+from sklearn.preprocessing import MaxAbsScaler, MinMaxScaler
 from sklearn.feature_selection import VarianceThreshold
 
 import warnings
@@ -61,8 +62,9 @@ class Rebuilder:
 
 
 def rebuild_from_file(descdir, modeldir, number):
-    trials = pd.read_table(os.path.join(modeldir, 'trials.all'), sep=' ')
-    rebuild_trial = trials[trials['trial'] == number].squeeze()
+    # read as text, so that the integer parameters are not converted to float by the missing values
+    trials = pd.read_table(os.path.join(modeldir, 'trials.all'), sep=' ', dtype=str)
+    rebuild_trial = trials[trials['trial'].astype(int) == number].squeeze()
 
     trial_preds = pd.read_table(os.path.join(modeldir, 'trial.'+str(number), 'predictions'), sep=' ')
     prop = list(trial_preds.columns)[1].removesuffix('.observed')
@@ -78,22 +80,18 @@ def rebuild_from_file(descdir, modeldir, number):
         desc_calculator = pickle.load(f)
     pipeline_steps.append(('descriptor_calculator', desc_calculator))
 
-    if rebuild_trial['scaling'] == 'scaled':
+    if rebuild_trial['scaling'] == 'maxabs':
+        pipeline_steps.append(('scaler', MaxAbsScaler()))
+    elif rebuild_trial['scaling'] == 'scaled':
+        # the tables of the previous versions were optimized with min-max scaling
         pipeline_steps.append(('scaler', MinMaxScaler()))
 
     pipeline_steps.append(('variance', VarianceThreshold()))
 
-    params = rebuild_trial[rebuild_trial.index[list(rebuild_trial.index).index('method')+1:]].to_dict()
-    for k, p in params.items():
-        if pd.isnull(p):
-            params[k] = None
-        ## The next check is necessary for max_features in RFR and RFC
-        if k == "max_features":
-            try:
-                params[k] = float(params[k])
-            except:
-                pass
     method = rebuild_trial['method']
+    # the table may contain the parameters of several methods, those of other methods are empty
+    param_names = rebuild_trial.index[list(rebuild_trial.index).index('method')+1:].drop('score', errors='ignore')
+    params = {k: _parse_value(rebuild_trial[k]) for k in param_names if not pd.isnull(rebuild_trial[k])}
     model = get_raw_model(method, params)
     pipeline_steps.append(('model', model))
 
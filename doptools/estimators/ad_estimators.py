@@ -1,11 +1,17 @@
 from sklearn.base import BaseEstimator, OutlierMixin, clone
+from doptools.optimizer.utils import load_descriptor_file
 from copy import deepcopy
 from sklearn.utils.validation import check_is_fitted
+from sklearn.utils.extmath import randomized_svd
+from scipy.sparse import issparse, csr_matrix
 from pandas import DataFrame
+import numpy as np
+import pandas as pd
 
 class FragmentControl(BaseEstimator, OutlierMixin):
-    def __init__(self, pipeline):
+    def __init__(self, pipeline, n_jobs=1):
         self.pipeline = pipeline
+        self.n_jobs = n_jobs
         self.fragmentor = deepcopy(pipeline[0])
         self.feature_names = []
         try: 
@@ -14,27 +20,43 @@ class FragmentControl(BaseEstimator, OutlierMixin):
         except:
             print("The pipeline is not fitted, you should fit it.")
 
-    def fit(self, X, y=None):
-        self.pipeline.fit(X, y)
+    def fit(self, X, y=None, descriptors=None):
+        # if the descriptors are given, they were calculated by the already fitted pipeline
+        if descriptors is None:
+            self.pipeline.fit(X, y)
         self.fragmentor = deepcopy(self.pipeline[0])
         self.feature_names = self.pipeline[0].get_feature_names()
         self.is_fitted_ = True
         return self
 
-    def predict(self, X, y=None):
+    def predict(self, X, y=None, descriptors=None):
+        # the unseen fragments are absent from the descriptors, so they are not used
+        return list(np.where(self.count_unseen(X) > 0, -1, 1))
+
+    def unseen_fragments(self, X):
+        """
+        Returns the list of fragments not found in the training set for each
+        sample. The fitted fragmentor is queried, not refitted. Fragmentors
+        without get_unseen_fragments are refitted on each sample (a copy, so
+        that the training features are kept).
+        """
+        if hasattr(self.fragmentor, "get_unseen_fragments"):
+            return self.fragmentor.get_unseen_fragments(X, n_jobs=self.n_jobs)
+        known = set(self.feature_names)
+        fragmentor = deepcopy(self.fragmentor)
         res = []
         for i in range(len(X)):
-            if isinstance(X, DataFrame):
-                x = X.iloc[i]
-            else:
-                x = [X[i]]
-            self.fragmentor.fit(x)
-            features = self.fragmentor.get_feature_names()
-            if len(set(features) - set(self.feature_names))>0:
-                res.append(-1)
-            else:
-                res.append(1)
-        return(res)
+            x = X.iloc[[i]] if isinstance(X, DataFrame) else [X[i]]
+            fragmentor.fit(x)
+            res.append([f for f in fragmentor.get_feature_names() if f not in known])
+        return res
+
+    def count_unseen(self, X):
+        """
+        Returns the number of fragments not found in the training set for
+        each sample.
+        """
+        return np.array([len(u) for u in self.unseen_fragments(X)], dtype=int)
         
 
 class BoundingBox(BaseEstimator, OutlierMixin):
@@ -42,67 +64,293 @@ class BoundingBox(BaseEstimator, OutlierMixin):
         self.pipeline = pipeline
         self.fragmentor = deepcopy(pipeline[0])
 
-    def fit(self, X, y=None, svm_file=None):
+    def fit(self, X, y=None, svm_file=None, descriptors=None):
         self.is_fitted_ = True
-        if svm_file is not None:
-            d, _ = load_svmlight_file(svm_file)
-            descs = d.toarray()
+        if descriptors is not None:
+            # the descriptors were calculated by the first step of the fitted pipeline
+            self.fragmentor = deepcopy(self.pipeline[0])
+            descs = descriptors
+        elif svm_file is not None:
+            descs, _ = load_descriptor_file(svm_file)
         else:
             descs = self.fragmentor.fit_transform(X)
-        self.min_limits = descs.min(axis=0)
-        self.max_limits = descs.max(axis=0)
+        self.min_limits = np.asarray(descs.min(axis=0).todense() if issparse(descs) else descs.min(axis=0), dtype=float).ravel()
+        self.max_limits = np.asarray(descs.max(axis=0).todense() if issparse(descs) else descs.max(axis=0), dtype=float).ravel()
         return self
 
-    def predict(self, X, y=None):
-        res = []
-        for i in range(len(X)):
-            if isinstance(X, DataFrame):
-                x = X.iloc[i]
-            else:
-                x = [X[i]]
-            desc = self.fragmentor.transform(x)
-            value = 1
-            for c in desc.columns:
-                if desc.iloc[0][c]>self.max_limits[c] or desc.iloc[0][c]<self.min_limits[c]:
-                    value = -1
-            res.append(value)
+    def predict(self, X, y=None, descriptors=None):
+        return list(np.where(self.count_violations(X, descriptors) > 0, -1, 1))
+
+    def count_violations(self, X, descriptors=None):
+        """
+        Returns the number of descriptors that are outside of the training
+        limits for each sample. The whole input is transformed at once,
+        unless the descriptors are already given.
+        """
+        if descriptors is None:
+            descriptors = self.fragmentor.transform(X)
+        return self._count_violations(descriptors)
+
+    def _count_violations(self, descs):
+        min_limits, max_limits = self.min_limits, self.max_limits
+        n_features = descs.shape[1]
+        if len(min_limits) < n_features:
+            # svmlight files omit the trailing columns that are zero for all samples
+            min_limits = np.pad(min_limits, (0, n_features-len(min_limits)))
+            max_limits = np.pad(max_limits, (0, n_features-len(max_limits)))
+        if issparse(descs):
+            descs = descs.tocsr()
+            # zeros are not stored, so their violations are counted per column and corrected
+            # by the stored values of each row
+            zero_out = ((min_limits > 0) | (max_limits < 0)).astype(int)
+            cols = descs.indices
+            stored_out = ((descs.data > max_limits[cols]) | (descs.data < min_limits[cols])).astype(int) - zero_out[cols]
+            row_sums = np.add.reduceat(np.append(stored_out, 0), descs.indptr[:-1]) if len(stored_out) else np.zeros(descs.shape[0], dtype=int)
+            row_sums[np.diff(descs.indptr) == 0] = 0
+            return row_sums + zero_out.sum()
+        descs = np.asarray(descs, dtype=float)
+        return ((descs > max_limits) | (descs < min_limits)).sum(axis=1)
+
+
+class TanimotoKNN(BaseEstimator, OutlierMixin):
+    """
+    Applicability domain based on the similarity to the k nearest training
+    samples. A sample is inside the AD if the mean Tanimoto similarity to its
+    k nearest neighbors in the training set is not lower than the threshold.
+
+    The training descriptors are kept in an index suited to their type: for
+    binary fingerprints the rows are packed into bits and the similarity is
+    calculated by popcount, for count descriptors (CircuS, ChyLine) a sparse
+    inverted index (feature -> training samples) is used, so only the samples
+    sharing at least one feature with the query are visited.
+    """
+    def __init__(self, pipeline, k=5, threshold=0.5, metric="auto"):
+        self.pipeline = pipeline
+        self.k = k
+        self.threshold = threshold
+        self.metric = metric
+        self.fragmentor = deepcopy(pipeline[0])
+
+    def fit(self, X, y=None, svm_file=None, descriptors=None):
+        self.is_fitted_ = True
+        if descriptors is not None:
+            self.fragmentor = deepcopy(self.pipeline[0])
+            descs = descriptors
+        elif svm_file is not None:
+            descs, _ = load_descriptor_file(svm_file)
+        else:
+            descs = self.fragmentor.fit_transform(X)
+        descs = csr_matrix(descs if issparse(descs) else np.asarray(descs, dtype=float))
+        self.n_features_ = descs.shape[1]
+        self.binary_ = self.metric == "binary" or (self.metric == "auto" and np.isin(descs.data, (0, 1)).all())
+        if self.binary_:
+            self._bits = self._pack(descs)
+            self._norms = _popcount(self._bits).sum(axis=1, dtype=np.int64)
+        else:
+            self._index = descs.T.tocsr()
+            self._norms = np.asarray(descs.multiply(descs).sum(axis=1)).ravel()
+        return self
+
+    def predict(self, X, y=None, descriptors=None):
+        similarity = self.kneighbors_similarity(X, descriptors).mean(axis=1)
+        return list(np.where(similarity >= self.threshold, 1, -1))
+
+    def kneighbors_similarity(self, X, descriptors=None):
+        """
+        Returns the Tanimoto similarities of each sample to its k nearest
+        training samples, in descending order (array of shape n_samples x k).
+        """
+        if descriptors is None:
+            descriptors = self.fragmentor.transform(X)
+        descs = csr_matrix(descriptors if issparse(descriptors) else np.asarray(descriptors, dtype=float))
+        if descs.shape[1] < self.n_features_:
+            descs.resize((descs.shape[0], self.n_features_))
+        descs = descs[:, :self.n_features_]
+        k = min(self.k, len(self._norms))
+        res = np.zeros((descs.shape[0], k))
+        if self.binary_:
+            bits = self._pack(descs)
+            norms = _popcount(bits).sum(axis=1, dtype=np.int64)
+            for i in range(len(bits)):
+                common = _popcount(self._bits & bits[i]).sum(axis=1, dtype=np.int64)
+                union = self._norms + norms[i] - common
+                res[i] = _top(np.divide(common, union, out=np.zeros(len(union)), where=union > 0), k)
+        else:
+            norms = np.asarray(descs.multiply(descs).sum(axis=1)).ravel()
+            for first, last in self._blocks(descs):
+                # products with all training samples sharing a feature with the queries of the block
+                products = (descs[first:last] @ self._index).tocsr()
+                for i in range(last - first):
+                    start, end = products.indptr[i], products.indptr[i+1]
+                    common = products.data[start:end]
+                    union = self._norms[products.indices[start:end]] + norms[first+i] - common
+                    similarity = np.divide(common, union, out=np.zeros(len(union)), where=union > 0)
+                    top = _top(similarity, min(k, len(similarity)))
+                    res[first+i, :len(top)] = top
         return res
 
+    def _blocks(self, descs, max_products=10**7):
+        # the queries are split into blocks of consecutive rows, so that the product of a block
+        # with the index has at most max_products nonzeros (or the block is a single query):
+        # common fragments are found in almost all training samples
+        bound = np.asarray((descs != 0).astype(np.int64) @ np.diff(self._index.indptr)).ravel()
+        total = np.concatenate([[0], np.cumsum(bound)])
+        first = 0
+        while first < len(bound):
+            last = max(first + 1, int(np.searchsorted(total, total[first] + max_products, side='right')) - 1)
+            yield first, last
+            first = last
+
+    def _pack(self, descs, chunk_size=10000):
+        # rows are packed into 64-bit words, padded with zero bits
+        n_words = (descs.shape[1] + 63)//64
+        packed = np.zeros((descs.shape[0], n_words*8), dtype=np.uint8)
+        for i in range(0, descs.shape[0], chunk_size):
+            bits = np.packbits(descs[i:i+chunk_size].toarray() > 0, axis=1)
+            packed[i:i+chunk_size, :bits.shape[1]] = bits
+        return packed.view(np.uint64)
+
+
+_POPCOUNT16 = np.array([bin(i).count("1") for i in range(2**16)], dtype=np.uint8)
+
+
+def _popcount(a):
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(a)
+    # numpy < 2.0 has no popcount, a lookup table over 16-bit halves is used instead
+    return _POPCOUNT16[a.view(np.uint16)]
+
+
+def _top(values, k):
+    if k == 0:
+        return values[:0]
+    if len(values) > k:
+        values = values[np.argpartition(values, -k)[-k:]]
+    return np.sort(values)[::-1]
+
+
+class Leverage(BaseEstimator, OutlierMixin):
+    """
+    Leverage (hat matrix) applicability domain. A sample is inside the AD if
+    its leverage h = x(X'X)^-1x' is not higher than the threshold, by default
+    the warning leverage 3(k+1)/n.
+
+    The training matrix is decomposed once at fit time as X = USV' and only
+    the projection V/S (n_features x k) is stored, so the leverage of the
+    queries is calculated by one matrix product: h = ||xV/S||^2. If
+    n_components is lower than the rank of the matrix, a randomized truncated
+    SVD is used, which works directly on sparse matrices. By default, the full
+    SVD is used only for dense matrices with more samples than features. For
+    sparse or wide matrices (CircuS spaces), whose rank is close to the number
+    of samples and for which the full leverage would exceed the threshold for
+    no sample, n_samples/10 components (at most 100) are kept.
+    """
+    def __init__(self, pipeline, n_components=None, threshold=None, tol=1e-10, random_state=0):
+        self.pipeline = pipeline
+        self.n_components = n_components
+        self.threshold = threshold
+        self.tol = tol
+        self.random_state = random_state
+        self.fragmentor = deepcopy(pipeline[0])
+
+    def fit(self, X, y=None, svm_file=None, descriptors=None):
+        self.is_fitted_ = True
+        if descriptors is not None:
+            self.fragmentor = deepcopy(self.pipeline[0])
+            descs = descriptors
+        elif svm_file is not None:
+            descs, _ = load_descriptor_file(svm_file)
+        else:
+            descs = self.fragmentor.fit_transform(X)
+        if not issparse(descs):
+            descs = np.asarray(descs, dtype=float)
+        n_samples, self.n_features_ = descs.shape
+        rank = min(descs.shape)
+        n_components = self.n_components
+        if n_components is None and (issparse(descs) or self.n_features_ >= n_samples):
+            n_components = max(1, min(100, n_samples//10))
+        if n_components is not None and n_components < rank:
+            _, s, vt = randomized_svd(descs, n_components, random_state=self.random_state)
+        else:
+            _, s, vt = np.linalg.svd(descs.toarray() if issparse(descs) else descs, full_matrices=False)
+        # directions with (numerically) zero singular values are outside of the training space
+        keep = s > self.tol*s.max() if len(s) and s.max() > 0 else np.zeros(len(s), dtype=bool)
+        self.projection_ = (vt[keep].T/s[keep]).astype(float)
+        self.n_components_ = int(keep.sum())
+        self.threshold_ = self.threshold if self.threshold is not None else 3*(self.n_components_+1)/n_samples
+        return self
+
+    def predict(self, X, y=None, descriptors=None):
+        return list(np.where(self.leverage(X, descriptors) > self.threshold_, -1, 1))
+
+    def leverage(self, X, descriptors=None):
+        """
+        Returns the leverage of each sample with respect to the training set.
+        """
+        if descriptors is None:
+            descriptors = self.fragmentor.transform(X)
+        descs = csr_matrix(descriptors) if issparse(descriptors) else np.asarray(descriptors, dtype=float)
+        n_features = descs.shape[1]
+        if n_features < self.n_features_:
+            # svmlight files omit the trailing columns that are zero for all samples
+            projection = self.projection_[:n_features]
+        else:
+            projection = self.projection_
+            descs = descs[:, :self.n_features_]
+        scores = np.asarray(descs @ projection)
+        return (scores**2).sum(axis=1)
+
+
 class PipelineWithAD(BaseEstimator):
-    def __init__(self, pipeline, ad_type, threshold=None):
+    def __init__(self, pipeline, ad_type, threshold=None, chunk_size=1000, n_components=None):
         self.ad_type = ad_type
         self.pipeline = pipeline
         self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.n_components = n_components
         if self.ad_type == "FragmentControl":
             self.ad_estimator = FragmentControl(self.pipeline)
         elif self.ad_type == "BoundingBox":
-            self.ad_estimator = BoudingBox(self.pipeline)
+            self.ad_estimator = BoundingBox(self.pipeline)
+        elif self.ad_type == "TanimotoKNN":
+            self.ad_estimator = TanimotoKNN(self.pipeline) if threshold is None else \
+                TanimotoKNN(self.pipeline, threshold=threshold)
+        elif self.ad_type == "Leverage":
+            self.ad_estimator = Leverage(self.pipeline, n_components=n_components, threshold=threshold)
 
-    def fit(self, X, y=None):
+    def fit(self, X, y=None, descriptors=None):
+        """
+        Fits the pipeline and the AD estimator. The descriptors are calculated
+        once for both. If they are given, the first step of the pipeline must
+        be already fitted and only the following steps are trained.
+        """
         self.is_fitted_ = True
-        self.pipeline.fit(X, y)
-        self.ad_estimator.fit(X, y)
+        if descriptors is None:
+            descriptors = self.pipeline[0].fit_transform(X, y)
+        self.pipeline[1:].fit(descriptors, y)
+        self.ad_estimator.fit(X, y, descriptors=descriptors)
         return self
 
     def predict(self, X, y=None):
-        res = []
-        for i in range(len(X)):
-            if isinstance(X, DataFrame):
-                x = X.iloc[i]
-            else:
-                x = [X[i]]
-            res.append((self.pipeline.predict(x)[0], self.ad_estimator.predict(x)[0]))
-        return pd.DataFrame(res, columns=["Predicted", "AD"])
+        preds, ad = [], []
+        for chunk in self._chunks(X):
+            # the descriptors are calculated once and shared by the model and the AD estimator
+            descs = self.pipeline[0].transform(chunk)
+            preds.append(np.asarray(self.pipeline[1:].predict(descs)))
+            ad.append(np.asarray(self.ad_estimator.predict(chunk, descriptors=descs)))
+        if not preds:
+            return pd.DataFrame(columns=["Predicted", "AD"])
+        return pd.DataFrame({"Predicted": np.concatenate(preds), "AD": np.concatenate(ad)})
 
     def predict_within_AD(self, X, y=None):
-        res = []
-        indices = []
-        for i in range(len(X)):
+        res = self.predict(X)
+        return res.loc[res["AD"] == 1, ["Predicted"]]
+
+    def _chunks(self, X):
+        for start in range(0, len(X), self.chunk_size):
             if isinstance(X, DataFrame):
-                x = X.iloc[i]
+                yield X.iloc[start:start+self.chunk_size].reset_index(drop=True)
+            elif isinstance(X, pd.Series):
+                yield list(X.iloc[start:start+self.chunk_size])
             else:
-                x = [X[i]]
-            if self.ad_estimator.predict(x)[0] == 1:
-                res.append(self.pipeline.predict(x)[0])
-                indices.append(i)
-        return pd.DataFrame(res, columns=["Predicted"], index=indices)
\ No newline at end of file
+                yield X[start:start+self.chunk_size]
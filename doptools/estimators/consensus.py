@@ -1,11 +1,41 @@
 from sklearn.base import BaseEstimator
 from typing import Tuple
 from sklearn import base
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+import hashlib
+from joblib import Parallel, delayed
 from doptools.estimators.ad_estimators import *
+import numpy as np
 import pandas as pd
 
+
+def _calculator_key(calculator):
+    """
+    Fingerprint of a fitted descriptor calculator: its class, parameters and
+    the hash of its feature vocabulary. Calculators with equal keys give the
+    same descriptors, so they can be computed once.
+    """
+    if not hasattr(calculator, "get_params") or not hasattr(calculator, "get_feature_names"):
+        return id(calculator)
+    vocabulary = hashlib.sha1("\n".join(map(str, calculator.get_feature_names())).encode()).hexdigest()
+    params = sorted((k, repr(v)) for k, v in calculator.get_params(deep=False).items())
+    return (type(calculator).__name__, repr(params), vocabulary)
+
+
+def _fit_member(member, X, y, descriptors):
+    # the first step is already fitted, the descriptors come from it
+    if isinstance(member, PipelineWithAD):
+        member.fit(X, y, descriptors=descriptors)
+    else:
+        member[1:].fit(descriptors, y)
+    return member
+
+
 class ConsensusModel(BaseEstimator):
-    def __init__(self, pipelines):
+    def __init__(self, pipelines, n_jobs=1, backend="loky"):
+        self.n_jobs = n_jobs
+        self.backend = backend
         self.model_type = "R"
         self.ad_type = None
         if isinstance(pipelines[0], Tuple):
@@ -24,16 +54,33 @@ class ConsensusModel(BaseEstimator):
                 self.model_type = "C"
 
     def fit(self, X, y=None):
-        for p in self.pipelines:
-            p.fit(X, y)
+        """
+        Fits all member pipelines. Descriptor calculators with the same class and
+        parameters are fitted once and their descriptor table is reused by all members
+        that have them. The rest of the members is then trained in parallel with joblib
+        (n_jobs, backend); large arrays are memory-mapped to the worker processes.
+        """
+        pipelines = [p.pipeline if isinstance(p, PipelineWithAD) else p for p in self.pipelines]
+        keys = [_calculator_key(p[0]) for p in pipelines]
+        fitted, descriptors = {}, {}
+        for k, p in zip(keys, pipelines):
+            if k not in descriptors:
+                descriptors[k] = p[0].fit_transform(X, y)
+                fitted[k] = p[0]
+            else:
+                p.steps[0] = (p.steps[0][0], deepcopy(fitted[k]))
+        members = Parallel(n_jobs=self.n_jobs, backend=self.backend)(
+            delayed(_fit_member)(m, X if isinstance(m, PipelineWithAD) else None, y, descriptors[k])
+            for m, k in zip(self.pipelines, keys))
+        self.pipelines = list(members)
         self.is_fitted_ = True
         return self
 
     def predict(self, X, y=None, output="all"):
-        preds = []
+        preds, ad = self._predict_members(X)
 
         if self.ad_type is None:
-            preds = np.array([p.predict(X) for p in self.pipelines]).T
+            preds = np.array(preds).T
             res = pd.DataFrame(preds, columns=self.names)
             if self.model_type == "R":
                 res["Pred.Avg."] = res.mean(axis=1)
@@ -41,11 +88,8 @@ class ConsensusModel(BaseEstimator):
                 res["Pred.Avg."] = res.mode(axis=1)
             res["Pred.StD."] = res.std(axis=1)
         else:
-            res = pd.concat([p.predict(X) for p in self.pipelines], axis=1)
-            col_names = []
-            for n in self.names:
-                col_names += [n, "AD_"+n]
-            res.columns = col_names
+            res = pd.DataFrame({c: v for n, p, a in zip(self.names, preds, ad)
+                                for c, v in ((n, p), ("AD_"+n, a))})
             if self.model_type == "R":
                 res["Pred.Avg."] = res[self.names].mean(axis=1)
             if self.model_type == "C":
@@ -60,6 +104,30 @@ class ConsensusModel(BaseEstimator):
         elif output=="preds":
             return res[self.names]
 
+    def _predict_members(self, X):
+        """
+        Predicts X with all member pipelines. The descriptors are calculated once per
+        unique descriptor calculator and shared by all members that use it; the members
+        (and the calculators) are evaluated concurrently if n_jobs > 1.
+        """
+        pipelines = [p.pipeline if isinstance(p, PipelineWithAD) else p for p in self.pipelines]
+        keys = [_calculator_key(p[0]) for p in pipelines]
+        calculators = {}
+        for k, p in zip(keys, pipelines):
+            calculators.setdefault(k, p[0])
+
+        def member(i):
+            descs = descriptors[keys[i]]
+            pred = np.asarray(pipelines[i][1:].predict(descs))
+            if isinstance(self.pipelines[i], PipelineWithAD):
+                return pred, np.asarray(self.pipelines[i].ad_estimator.predict(X, descriptors=descs))
+            return pred, None
+
+        with ThreadPoolExecutor(max_workers=max(1, self.n_jobs)) as executor:
+            descriptors = dict(zip(calculators.keys(), executor.map(lambda c: c.transform(X), calculators.values())))
+            results = list(executor.map(member, range(len(pipelines))))
+        return [r[0] for r in results], [r[1] for r in results]
+
     def predict_within_AD(self, X, y=None, output="all"):
         if self.ad_type is None:
             return self.predict(X, y, output)
@@ -30,6 +30,10 @@ methods = {'SVR': "SVR(**params, gamma='auto')",
            'RFR': "RandomForestRegressor(**params)",
            'RFC': "RandomForestClassifier(**params)"}
 
+# methods that are trained directly on sparse descriptor matrices. XGBoost is not among them,
+# as it treats the zeros not stored in a sparse matrix as missing values
+sparse_methods = ['SVR', 'SVC', 'RFR', 'RFC']
+
 calculators = {
     'circus': "ChythonCircus(**descriptor_params)",
     'chyline': "ChythonLinear(**descriptor_params)",
@@ -63,81 +67,82 @@ def get_raw_calculator(desc_type: str, descriptor_params=None):
         raise ValueError("Unknown descriptors type "+desc_type+". Allowed values: "+", ".join(calculators.keys()))
 
 
-def suggest_params(trial, method):
+def suggest_params(trial, method, prefix=''):
+    # the prefix makes the parameter names unique when several methods are optimized in one study
     if method == 'SVR':
         params = { 
-            'C': trial.suggest_float('C', 1e-9, 1e9, log=True),
-            'kernel': trial.suggest_categorical('kernel', ['linear', 'rbf', 'poly', 'sigmoid']),
-            'coef0': trial.suggest_float('r0', -10, 10)
+            'C': trial.suggest_float(prefix + 'C', 1e-9, 1e9, log=True),
+            'kernel': trial.suggest_categorical(prefix + 'kernel', ['linear', 'rbf', 'poly', 'sigmoid']),
+            'coef0': trial.suggest_float(prefix + 'r0', -10, 10)
         }
     elif method == 'SVC':
         params = { 
-            'C': trial.suggest_float('C', 1e-9, 1e9, log=True),
-            'kernel': trial.suggest_categorical('kernel', ['linear', 'rbf', 'poly', 'sigmoid']),
-            'coef0': trial.suggest_float('r0', -10, 10)
+            'C': trial.suggest_float(prefix + 'C', 1e-9, 1e9, log=True),
+            'kernel': trial.suggest_categorical(prefix + 'kernel', ['linear', 'rbf', 'poly', 'sigmoid']),
+            'coef0': trial.suggest_float(prefix + 'r0', -10, 10)
         }   
     elif method == 'LGBMR':
         params = {
-            "n_estimators": trial.suggest_categorical("n_estimators", [100]),
-            "learning_rate": trial.suggest_float("learning_rate", 0.01, 0.3),
-            "num_leaves": trial.suggest_int("num_leaves", 20, 3000, step=10),
-            "max_depth": trial.suggest_int("max_depth", 3, 12),
-            "min_data_in_leaf": trial.suggest_int("min_data_in_leaf", 50, 1000, step=10),
-            "max_bin": trial.suggest_int("max_bin", 200, 300),
-            "lambda_l1": trial.suggest_int("lambda_l1", 0, 100, step=5),
-            "lambda_l2": trial.suggest_int("lambda_l2", 0, 100, step=5),
-            "min_gain_to_split": trial.suggest_float("min_gain_to_split", 0, 15),
+            "n_estimators": trial.suggest_categorical(prefix + "n_estimators", [100]),
+            "learning_rate": trial.suggest_float(prefix + "learning_rate", 0.01, 0.3),
+            "num_leaves": trial.suggest_int(prefix + "num_leaves", 20, 3000, step=10),
+            "max_depth": trial.suggest_int(prefix + "max_depth", 3, 12),
+            "min_data_in_leaf": trial.suggest_int(prefix + "min_data_in_leaf", 50, 1000, step=10),
+            "max_bin": trial.suggest_int(prefix + "max_bin", 200, 300),
+            "lambda_l1": trial.suggest_int(prefix + "lambda_l1", 0, 100, step=5),
+            "lambda_l2": trial.suggest_int(prefix + "lambda_l2", 0, 100, step=5),
+            "min_gain_to_split": trial.suggest_float(prefix + "min_gain_to_split", 0, 15),
             "bagging_fraction": trial.suggest_float(
-                "bagging_fraction", 0.2, 0.95, step=0.1
+                prefix + "bagging_fraction", 0.2, 0.95, step=0.1
             ),
-            "bagging_freq": trial.suggest_categorical("bagging_freq", [1]),
+            "bagging_freq": trial.suggest_categorical(prefix + "bagging_freq", [1]),
             "feature_fraction": trial.suggest_float(
-                "feature_fraction", 0.2, 0.95, step=0.1
+                prefix + "feature_fraction", 0.2, 0.95, step=0.1
             ),
         }
     elif method == 'XGBR':
         params = {
-            'max_depth': trial.suggest_int("max_depth", 3, 18),
-            'eta': trial.suggest_float('eta', 1e-9, 1, log=True),
-            'gamma': trial.suggest_float('gamma', 1, 9),
-            'reg_alpha': trial.suggest_int('reg_alpha', 10, 180),
-            'reg_lambda': trial.suggest_float('reg_lambda', 0, 1),
-            'colsample_bytree': trial.suggest_float('colsample_bytree', 0.5, 1),
-            'min_child_weight': trial.suggest_int('min_child_weight', 0, 10),
-            'n_estimators': trial.suggest_categorical("n_estimators", [20, 50, 100, 150, 200]),
-            'subsample': trial.suggest_float('subsample', 0.5, 1),
-            'sampling_method': trial.suggest_categorical('sampling_method', ['uniform']),
-            'booster': trial.suggest_categorical('booster', ['gbtree', 'gblinear', 'dart']),
-            'tree_method': trial.suggest_categorical('tree_method', ['auto', 'exact', 'approx', 'hist']) 
+            'max_depth': trial.suggest_int(prefix + "max_depth", 3, 18),
+            'eta': trial.suggest_float(prefix + 'eta', 1e-9, 1, log=True),
+            'gamma': trial.suggest_float(prefix + 'gamma', 1, 9),
+            'reg_alpha': trial.suggest_int(prefix + 'reg_alpha', 10, 180),
+            'reg_lambda': trial.suggest_float(prefix + 'reg_lambda', 0, 1),
+            'colsample_bytree': trial.suggest_float(prefix + 'colsample_bytree', 0.5, 1),
+            'min_child_weight': trial.suggest_int(prefix + 'min_child_weight', 0, 10),
+            'n_estimators': trial.suggest_categorical(prefix + "n_estimators", [20, 50, 100, 150, 200]),
+            'subsample': trial.suggest_float(prefix + 'subsample', 0.5, 1),
+            'sampling_method': trial.suggest_categorical(prefix + 'sampling_method', ['uniform']),
+            'booster': trial.suggest_categorical(prefix + 'booster', ['gbtree', 'gblinear', 'dart']),
+            'tree_method': trial.suggest_categorical(prefix + 'tree_method', ['auto', 'exact', 'approx', 'hist']) 
         }
     elif method == 'XGBC':
         params = {
-            'max_depth': trial.suggest_int("max_depth", 3, 18),
-            'eta': trial.suggest_float('eta', 1e-9, 1, log=True),
-            'gamma': trial.suggest_float('gamma', 1, 9),
-            'reg_alpha': trial.suggest_int('reg_alpha', 10, 180),
-            'reg_lambda': trial.suggest_float('reg_lambda', 0, 1),
-            'colsample_bytree': trial.suggest_float('colsample_bytree', 0.5, 1),
-            'min_child_weight': trial.suggest_int('min_child_weight', 0, 10),
-            'n_estimators': trial.suggest_categorical("n_estimators", [20, 50, 100, 150, 200]),
-            'subsample': trial.suggest_float('subsample', 0.5, 1),
-            'sampling_method': trial.suggest_categorical('sampling_method', ['uniform']),
-            'booster': trial.suggest_categorical('booster', ['gbtree', 'gblinear', 'dart']),
-            'tree_method': trial.suggest_categorical('tree_method', ['auto', 'exact', 'approx', 'hist'])
+            'max_depth': trial.suggest_int(prefix + "max_depth", 3, 18),
+            'eta': trial.suggest_float(prefix + 'eta', 1e-9, 1, log=True),
+            'gamma': trial.suggest_float(prefix + 'gamma', 1, 9),
+            'reg_alpha': trial.suggest_int(prefix + 'reg_alpha', 10, 180),
+            'reg_lambda': trial.suggest_float(prefix + 'reg_lambda', 0, 1),
+            'colsample_bytree': trial.suggest_float(prefix + 'colsample_bytree', 0.5, 1),
+            'min_child_weight': trial.suggest_int(prefix + 'min_child_weight', 0, 10),
+            'n_estimators': trial.suggest_categorical(prefix + "n_estimators", [20, 50, 100, 150, 200]),
+            'subsample': trial.suggest_float(prefix + 'subsample', 0.5, 1),
+            'sampling_method': trial.suggest_categorical(prefix + 'sampling_method', ['uniform']),
+            'booster': trial.suggest_categorical(prefix + 'booster', ['gbtree', 'gblinear', 'dart']),
+            'tree_method': trial.suggest_categorical(prefix + 'tree_method', ['auto', 'exact', 'approx', 'hist'])
         }
     elif method == 'RFR':
         params = {
-            'max_depth': trial.suggest_int("max_depth", 3, 10),
-            'max_features': trial.suggest_categorical('max_features', ['sqrt', 'log2', 1.0, 0.5]),
-            'max_samples': trial.suggest_categorical('max_samples', [0.2, 0.3, 0.5, 0.7, 0.8, 1]),
-            'n_estimators': trial.suggest_categorical("n_estimators", [20, 50, 100, 150, 200]),
+            'max_depth': trial.suggest_int(prefix + "max_depth", 3, 10),
+            'max_features': trial.suggest_categorical(prefix + 'max_features', ['sqrt', 'log2', 1.0, 0.5]),
+            'max_samples': trial.suggest_categorical(prefix + 'max_samples', [0.2, 0.3, 0.5, 0.7, 0.8, 1]),
+            'n_estimators': trial.suggest_categorical(prefix + "n_estimators", [20, 50, 100, 150, 200]),
         }
     elif method == 'RFC':
         params = {
-            'max_depth': trial.suggest_int("max_depth", 3, 10),
-            'max_features': trial.suggest_categorical('max_features', ['sqrt', 'log2', 1.0, 0.5]),
-            'max_samples': trial.suggest_categorical('max_samples', [0.2, 0.3, 0.5, 0.7, 0.8, 1]),
-            'n_estimators': trial.suggest_categorical("n_estimators", [20, 50, 100, 150, 200]),
+            'max_depth': trial.suggest_int(prefix + "max_depth", 3, 10),
+            'max_features': trial.suggest_categorical(prefix + 'max_features', ['sqrt', 'log2', 1.0, 0.5]),
+            'max_samples': trial.suggest_categorical(prefix + 'max_samples', [0.2, 0.3, 0.5, 0.7, 0.8, 1]),
+            'n_estimators': trial.suggest_categorical(prefix + "n_estimators", [20, 50, 100, 150, 200]),
         }
     else:
         raise ValueError("Unknown method")
@@ -145,4 +150,4 @@ def suggest_params(trial, method):
     return params
 
 
-__all__ = ['calculators', 'methods', 'suggest_params', 'get_raw_calculator', 'get_raw_model']
+__all__ = ['calculators', 'methods', 'sparse_methods', 'suggest_params', 'get_raw_calculator', 'get_raw_model']
@@ -17,141 +17,470 @@
 #  along with this program; if not, see <https://www.gnu.org/licenses/>.
 
 import glob
+import heapq
 import os
 import warnings
 import json
+import multiprocessing as mp
 import copy
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
-from multiprocessing import Manager
+from importlib.util import find_spec
+import pickle
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
 from scipy.sparse import issparse
 
 import numpy as np
 import pandas as pd
 import optuna
-from optuna.study import StudyDirection
+try:
+    from optuna.storages.journal import JournalFileBackend, JournalStorage
+except ImportError:  # optuna < 4.0
+    from optuna.storages import JournalFileStorage as JournalFileBackend, JournalStorage
+from optuna.distributions import CategoricalDistribution, FloatDistribution, IntDistribution
+from optuna.storages import RDBStorage, RetryFailedTrialCallback
+from optuna.study import MaxTrialsCallback, StudyDirection
+from optuna.trial import TrialState
 from sklearn.datasets import load_svmlight_file
 from sklearn.feature_selection import VarianceThreshold
 from sklearn.metrics import accuracy_score, balanced_accuracy_score, f1_score, roc_auc_score
 from sklearn.metrics import matthews_corrcoef
 from sklearn.metrics import mean_absolute_error as mae
+from sklearn.base import clone
+from sklearn.linear_model import Ridge, RidgeClassifier
 from sklearn.model_selection import KFold, cross_val_predict
-from sklearn.preprocessing import LabelBinarizer, LabelEncoder, MinMaxScaler
-from sklearn.utils import shuffle
-from timeout_decorator import TimeoutError
-from timeout_decorator import timeout_decorator
+from sklearn.preprocessing import LabelBinarizer, LabelEncoder, MaxAbsScaler, MinMaxScaler
+from sklearn.utils import resample, shuffle
 
-from doptools.optimizer.config import get_raw_model, suggest_params
-from doptools.optimizer.utils import r2, rmse
+from doptools.optimizer.config import get_raw_model, sparse_methods, suggest_params
+from doptools.optimizer.utils import _parse_value, load_descriptors, r2, rmse
+
+# pyarrow is optional, if installed it is used for faster parsing of CSV descriptor files
+_csv_engine = 'pyarrow' if find_spec('pyarrow') is not None else 'c'
+# pandas reads and writes Parquet files with pyarrow or fastparquet
+_parquet_available = find_spec('pyarrow') is not None or find_spec('fastparquet') is not None
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=DeprecationWarning)
+warnings.simplefilter(action='ignore', category=optuna.exceptions.ExperimentalWarning)
 
 optuna.logging.set_verbosity(optuna.logging.WARNING)
 
 
 class TopNPatienceCallback:
+    """
+    Stops the study if the N best trials have not changed for the given
+    number of finished trials. The leaders are kept in a heap updated from
+    each finished trial.
+
+    When the trials are run by several worker processes, a single callback
+    is kept by the main process, which feeds it the trials finished by all
+    the workers (see _optimize_in_processes) and stops the workers.
+    """
     def __init__(self, patience: int, leaders: int = 1):
         self.patience = patience
         self.leaders = leaders
         self._leaders_unchanged_steps = 0
         self._previous_leaders = ()
+        self._heap = []
+        self._direction = 1
+        self.n_trials = 0
+        self.n_improvements = 0
 
     def __call__(self, study: optuna.study.Study, trial: optuna.trial.FrozenTrial) -> None:
-        if len(study.trials_dataframe()) < self.leaders:
+        self.update(trial, study.direction)
+        if self.should_stop:
+            study.stop()
+
+    def update(self, trial, direction=StudyDirection.MAXIMIZE):
+        """
+        Takes one finished trial of a study with the given direction.
+        """
+        self._direction = 1 if direction == StudyDirection.MAXIMIZE else -1
+        self._push(trial)
+        self.n_trials += 1
+        if self.n_trials < self.leaders:
             return
 
-        if study.direction == StudyDirection.MAXIMIZE:
-            new_leaders = tuple(study.trials_dataframe().sort_values(by='value', ascending=False).head(self.leaders).number)
-        else:
-            new_leaders = tuple(study.trials_dataframe().sort_values(by='value', ascending=True).head(self.leaders).number)
+        new_leaders = tuple(-number for _, number in sorted(self._heap, reverse=True))
 
         if new_leaders == self._previous_leaders:
             self._leaders_unchanged_steps += 1
         else:
             self._leaders_unchanged_steps = 0
             self._previous_leaders = new_leaders
+            self.n_improvements += 1
 
-        if self._leaders_unchanged_steps >= self.patience:
-            study.stop()
+    def _push(self, trial):
+        if trial.state != TrialState.COMPLETE or trial.value is None:
+            return
+        # min-heap of the N best (signed) values, ties are resolved in favour of the earlier trial
+        item = (self._direction*trial.value, -trial.number)
+        if len(self._heap) < self.leaders:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    @property
+    def should_stop(self):
+        return self._leaders_unchanged_steps >= self.patience
+
+    @property
+    def steps_since_improvement(self):
+        return self._leaders_unchanged_steps
+
+    @property
+    def improvement_rate(self):
+        """
+        Fraction of the finished trials that changed the leaders.
+        """
+        return self.n_improvements/self.n_trials if self.n_trials else 0.
+
+    @property
+    def best_value(self):
+        if not self._heap:
+            return None
+        return self._direction*max(self._heap)[0]
+
+
+def _read_descriptor_file(f, fmt):
+    fullname = f.split(os.sep)[-1]
+    propname = fullname.split('.')[0]
+    name = fullname[len(propname)+1:-len(fmt)-1]
+    if fmt == 'svm':
+        X, y = load_svmlight_file(f)
+    elif fmt == 'csr':
+        X, y, _ = load_descriptors(f)
+    elif fmt in ('csv', 'parquet'):
+        if fmt == 'csv':
+            data = pd.read_csv(f, engine=_csv_engine)
+        else:
+            data = pd.read_parquet(f)
+        # the property column is followed by the descriptors
+        col_idx = list(data.columns).index(propname)
+        y = data[propname].to_numpy()
+        X = data.iloc[:, col_idx+1:].to_numpy(dtype=np.float32)
+    else:
+        raise ValueError("Unknown descriptors format "+fmt+". Allowed values: svm, csr, csv, parquet")
+    return propname, name, X, y
 
 
-def collect_data(datadir, task, fmt='svm'):
+def collect_data(datadir, task, fmt='svm', n_jobs=1):
+    """
+    Reads the descriptor files of the given format from the directory. The
+    files are read in parallel by n_jobs threads.
+    """
     desc_dict = {}
     y = {}
-    for f in glob.glob(os.path.join(datadir,"*."+fmt)):
-        propname = f.split(os.sep)[-1].split('.')[0]
-        name = f.split(os.sep)[-1][len(propname)+1:-4]
-        fullname = f.split(os.sep)[-1]
-        if fmt == 'svm':
-            desc_dict[name], y[propname] = load_svmlight_file(f)
-        elif fmt == 'csv':
-            data = pd.read_table(f)
-            y[propname] = data[propname]
-            col_idx = list(data.columns).index()
-            desc_dict[name] = data.iloc[:, col_idx+1:]
+    files = sorted(glob.glob(os.path.join(datadir, "*."+fmt)))
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        for propname, name, X, prop in executor.map(partial(_read_descriptor_file, fmt=fmt), files):
+            desc_dict[name], y[propname] = X, prop
     if task.endswith('C'):
         return desc_dict, pd.DataFrame(y, dtype=int)
     else:
         return desc_dict, pd.DataFrame(y)
 
 
-def calculate_scores(task, obs, pred):
-    def create_row(task, stat_name, x, y):
-        if task == 'R':
-            return {'stat': stat_name, 'R2': r2(x, y), 'RMSE': rmse(x, y), 'MAE': mae(x, y)}
-        elif task == 'C' and len(set(x)) == 2:
-            return {'stat': stat_name, 'ROC_AUC': roc_auc_score(x, y), 'ACC': accuracy_score(x, y),
-                    'BAC': balanced_accuracy_score(x, y), 'F1': f1_score(x, y),'MCC': matthews_corrcoef(x, y)}
-        elif task == 'C' and len(set(x)) > 2:
-            return {'stat': stat_name, 'ROC_AUC': roc_auc_score(LabelBinarizer().fit_transform(x),
-                                                                LabelBinarizer().fit_transform(y), multi_class='ovr'),
-                    'ACC': accuracy_score(x, y),
-                    'BAC': balanced_accuracy_score(x, y),
-                    'F1': f1_score(x, y, average='macro'),
-                    'MCC': matthews_corrcoef(x, y)}
+def _regression_scores(obs, preds):
+    # obs is a vector, preds a 2D array with one prediction per column
+    errors = preds - obs[:, None]
+    ss_tot = np.sum((obs - obs.mean())**2)
+    return {'R2': 1. - np.sum(errors**2, axis=0)/ss_tot,
+            'RMSE': np.sqrt(np.mean(errors**2, axis=0)),
+            'MAE': np.mean(np.abs(errors), axis=0)}
+
+
+def _classification_scores(obs, preds):
+    # confusion matrices of all prediction columns are counted at once
+    classes, encoded = np.unique(np.concatenate([obs, preds.ravel(order='F')]), return_inverse=True)
+    n, k, n_classes = len(obs), preds.shape[1], len(classes)
+    true, pred = encoded[:n], encoded[n:].reshape((k, n))
+    cm = np.bincount(((np.arange(k)[:, None]*n_classes + true[None, :])*n_classes + pred).ravel(),
+                     minlength=k*n_classes*n_classes).reshape((k, n_classes, n_classes)).astype(float)
+    tp = np.diagonal(cm, axis1=1, axis2=2)
+    support, predicted = cm.sum(axis=2), cm.sum(axis=1)
+    present = support[0] > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        recall = tp[:, present]/support[:, present]
+        specificity = (n - support - predicted + tp)[:, present]/(n - support[:, present])
+        f1 = np.nan_to_num(2*tp/(support + predicted))
+        mcc_den = np.sqrt((n**2 - np.sum(predicted**2, axis=1))*(n**2 - np.sum(support**2, axis=1)))
+        mcc = np.where(mcc_den > 0, (tp.sum(axis=1)*n - np.sum(support*predicted, axis=1))/mcc_den, 0.)
+    scores = {'ROC_AUC': np.mean((recall + specificity)/2, axis=1),
+              'ACC': tp.sum(axis=1)/n,
+              'BAC': recall.mean(axis=1)}
+    if present.sum() == 2:
+        # the positive class is 1, as in sklearn, or the greater label
+        positive = list(classes).index(1) if 1 in classes else np.flatnonzero(present)[-1]
+        scores['F1'] = f1[:, positive]
+    else:
+        scores['F1'] = f1.mean(axis=1)
+    scores['MCC'] = mcc
+    return scores
 
+
+def calculate_scores(task, obs, pred):
     if task == 'R':
-        score_df = pd.DataFrame(columns=['stat', 'R2', 'RMSE', 'MAE'])
+        columns = ['stat', 'R2', 'RMSE', 'MAE']
     elif task == 'C':
-        score_df = pd.DataFrame(columns=['stat', 'ROC_AUC', 'ACC', 'BAC', 'F1', "MCC"])
+        columns = ['stat', 'ROC_AUC', 'ACC', 'BAC', 'F1', "MCC"]
     else:
         raise ValueError("Unknown task type")
 
+    blocks = []
     for c in obs.columns:
-        preds_partial = pred[[d for d in pred.columns if c+'.predicted.' in d]]
-        for p in preds_partial.columns:
-            added_row = create_row(task, p, obs[c], preds_partial[p])
-            score_df = pd.concat([pd.DataFrame(added_row, index=[0]), score_df.loc[:]]).reset_index(drop=True)
+        preds_partial = pred.filter(like=c+'.predicted.')
+        values = preds_partial.to_numpy(dtype=float)
+        # the consensus is scored together with the individual predictions
         if task == 'R':
-            added_row = create_row(task, c+'.consensus', obs[c], preds_partial.mean(axis=1))
-        elif task == 'C':
-            added_row = create_row(task, c+'.consensus', obs[c], np.round(preds_partial.mean(axis=1)))
-        score_df = pd.concat([pd.DataFrame(added_row, index=[0]), score_df.loc[:]]).reset_index(drop=True)
+            values = np.column_stack([values, values.mean(axis=1)])
+            scores = _regression_scores(obs[c].to_numpy(dtype=float), values)
+        else:
+            values = np.column_stack([values, np.round(values.mean(axis=1))])
+            scores = _classification_scores(obs[c].to_numpy(dtype=float), values)
+        stats = list(preds_partial.columns) + [c+'.consensus']
+        # the consensus comes first, followed by the predictions in reverse order
+        blocks.append(pd.DataFrame({'stat': stats, **scores}, columns=columns).iloc[::-1])
+    score_df = pd.concat(blocks[::-1], ignore_index=True) if blocks else pd.DataFrame(columns=columns)
     return score_df
 
 
-def objective_study(storage, results_detailed, trial, x_dict, y, outdir, method, ntrials,
-                    cv_splits, cv_repeats, jobs, tmout, earlystop, write_output: bool = True):
+def _fit_predict_fold(model, X, Y, train, test, proba):
+    model = clone(model).fit(X[train], Y[train])
+    preds = model.predict(X[test])
+    if not proba:
+        return test, preds, None
+    # the classes absent from the training fold get zero probability
+    probas = np.zeros((len(test), len(np.unique(Y))))
+    probas[:, model.classes_] = model.predict_proba(X[test])
+    return test, preds, probas
+
+
+def cross_val_fold_predict(model, X, Y, cv_splits, proba=False, n_jobs=1, callback=None):
+    """
+    Returns the cross-validated predictions and, if proba is True, the
+    class probabilities (Y should be label encoded in this case). Each fold
+    model is trained once, the folds are processed in parallel by n_jobs
+    threads: the folds share the descriptor matrix without copying it to
+    other processes, and the fitting of the models mostly releases the GIL.
+
+    The callback, if given, is called as callback(done, preds) each time a
+    fold is finished, done being the mask of the predicted samples. An
+    exception raised by the callback cancels the remaining folds.
+    """
+    Y = np.asarray(Y)
+    preds, probas = None, np.zeros((len(Y), len(np.unique(Y)))) if proba else None
+    done = np.zeros(len(Y), dtype=bool)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(_fit_predict_fold, model, X, Y, train, test, proba)
+                   for train, test in KFold(cv_splits).split(X)]
+        try:
+            for future in as_completed(futures):
+                test, fold_preds, fold_probas = future.result()
+                if preds is None:
+                    preds = np.empty(len(Y), dtype=fold_preds.dtype)
+                preds[test] = fold_preds
+                if proba:
+                    probas[test] = fold_probas
+                done[test] = True
+                if callback is not None:
+                    callback(done, preds)
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return preds, probas
+
+
+# preprocessed descriptor matrices of the current process, keyed by (descriptor, scaling, sparse);
+# at most _descriptor_cache_size matrices are kept, the least recently used one is dropped first
+_descriptor_cache = OrderedDict()
+_descriptor_cache_size = 8
+_descriptor_cache_lock = threading.Lock()
+
+
+def preprocess_descriptors(X, scaling, sparse=True):
+    """
+    Applies the scaling and removes the constant descriptors. The studies
+    use max-abs scaling ("maxabs"), as it keeps the sparse matrices sparse,
+    "scaled" is the min-max scaling of the tables written by the previous
+    versions. If sparse is False, the result is converted to a dense float32
+    array, for the models that do not accept sparse input.
+    """
+    if scaling == 'maxabs':
+        X = MaxAbsScaler().fit_transform(X)
+    elif scaling == 'scaled':
+        X = MinMaxScaler().fit_transform(X.toarray() if issparse(X) else X)
+
+    X = VarianceThreshold().fit_transform(X)
+    if issparse(X) and not sparse:
+        X = X.astype(np.float32).toarray()
+    return X
+
+
+def get_preprocessed_descriptors(x_dict, desc, scaling, sparse=True):
+    """
+    Returns the preprocessed matrix of the given descriptor space. The
+    matrix is calculated once per process and reused by the following trials,
+    as long as it is among the _descriptor_cache_size most recently used.
+    """
+    key = (desc, scaling, sparse)
+    with _descriptor_cache_lock:
+        cached = _descriptor_cache.get(key)
+        if cached is not None:
+            _descriptor_cache.move_to_end(key)
+    # the raw matrix is kept with the result, so that a different data set with
+    # the same descriptor names is not served from the cache
+    if cached is None or cached[0] is not x_dict[desc]:
+        cached = (x_dict[desc], preprocess_descriptors(x_dict[desc], scaling, sparse))
+        with _descriptor_cache_lock:
+            _descriptor_cache[key] = cached
+            while len(_descriptor_cache) > _descriptor_cache_size:
+                _descriptor_cache.popitem(last=False)
+    return cached[1]
+
+
+def _drop_cached_descriptors(keep):
+    """
+    Removes the cached matrices of the descriptor spaces that are not in keep.
+    """
+    with _descriptor_cache_lock:
+        for key in [k for k in _descriptor_cache if k[0] not in keep]:
+            del _descriptor_cache[key]
+
+
+def screen_descriptors(x_dict, y, task, max_rows=1000, cv_splits=3, n_jobs=1, random_state=0):
+    """
+    Ranks the descriptor spaces by the cross-validated score (R2 or balanced
+    accuracy) of a ridge model trained on at most max_rows rows of the
+    scaled descriptors. Returns the scores, the best descriptor space first.
+    """
+    Y = np.array(y[y.columns[0]])
+    rows = np.arange(len(Y))
+    if len(rows) > max_rows:
+        rows = np.sort(resample(rows, replace=False, n_samples=max_rows, random_state=random_state,
+                                stratify=Y if task.endswith('C') else None))
+    Y = Y[rows]
+    model = RidgeClassifier() if task.endswith('C') else Ridge()
+    cv = KFold(n_splits=cv_splits, shuffle=True, random_state=random_state)
+
+    def score(desc):
+        X = get_preprocessed_descriptors(x_dict, desc, 'maxabs')[rows]
+        preds = cross_val_predict(model, X, Y, cv=cv)
+        return balanced_accuracy_score(Y, preds) if task.endswith('C') else r2(Y, preds)
+
+    with ThreadPoolExecutor(max_workers=max(n_jobs, 1)) as executor:
+        scores = list(executor.map(score, x_dict.keys()))
+    return pd.Series(scores, index=list(x_dict.keys()), name='score').sort_values(ascending=False, kind='stable')
+
+
+_finished_states = (TrialState.COMPLETE, TrialState.PRUNED, TrialState.FAIL)
+# the trials counted against the number of trials when several workers run them
+_counted_states = _finished_states + (TrialState.RUNNING,)
+
+# the worker is killed when its trial runs for longer than the timeout multiplied by this factor
+_timeout_grace = 1.5
+
+
+def _temporary_file(suffix):
+    f = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    f.close()
+    return f.name
+
+
+class MemoryResultStore:
+    """
+    Keeps the results of the trials (per trial number and key) in the
+    current process. Used when the trials are run by threads.
+    """
+    def __init__(self):
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def put(self, number, key, value):
+        with self._lock:
+            self._records.setdefault(number, {})[key] = value
+
+    def get(self, number):
+        with self._lock:
+            return dict(self._records.get(number, {}))
+
+    def numbers(self):
+        with self._lock:
+            return list(self._records.keys())
+
+
+class FileResultStore(MemoryResultStore):
+    """
+    Results store shared by the processes running the trials. Each result
+    is appended to the file as one pickled record, the reading process
+    loads the new records incrementally.
+    """
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self._offset = 0
+        open(self.path, 'ab').close()
+
+    def put(self, number, key, value):
+        data = pickle.dumps((number, key, value), protocol=pickle.HIGHEST_PROTOCOL)
+        # one write call in append mode, so that the records of several processes do not interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, struct.pack('<Q', len(data)) + data)
+        finally:
+            os.close(fd)
+
+    def get(self, number):
+        self._load()
+        return super().get(number)
+
+    def numbers(self):
+        self._load()
+        return super().numbers()
+
+    def _load(self):
+        with self._lock, open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                size = struct.unpack('<Q', header)[0]
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                number, key, value = pickle.loads(data)
+                self._records.setdefault(number, {})[key] = value
+                self._offset = f.tell()
+
+
+def objective_study(results_store, trial, x_dict, y, outdir, method, ntrials,
+                    cv_splits, cv_repeats, jobs, tmout, earlystop, write_output: bool = True, cv_jobs: int = 1):
     n = trial.number
+    start_time = time.time()
     if write_output and not os.path.exists(os.path.join(outdir, 'trial.' + str(n))):
         os.mkdir(os.path.join(outdir, 'trial.' + str(n)))
     res_pd = pd.DataFrame(columns=['data_index'])
     res_pd['data_index'] = np.arange(1, len(y) + 1, step=1).astype(int)
 
-    desc = trial.suggest_categorical('desc_type', list(x_dict.keys()))
-    scaling = trial.suggest_categorical('scaling', ['scaled', 'original'])
+    prefix = ''
+    if not isinstance(method, str):
+        # several methods are optimized jointly, their parameters are conditional on the method
+        method = trial.suggest_categorical('method', list(method))
+        prefix = method + '_'
 
-    X = x_dict[desc]
-    if issparse(X):
-        X = X.toarray()
-
-    if scaling == 'scaled':
-        mms = MinMaxScaler()
-        X = mms.fit_transform(X)
+    desc = trial.suggest_categorical('desc_type', list(x_dict.keys()))
+    scaling = trial.suggest_categorical('scaling', ['maxabs', 'original'])
 
-    X = VarianceThreshold().fit_transform(X)
+    X = get_preprocessed_descriptors(x_dict, desc, scaling, sparse=method in sparse_methods)
 
-    params = suggest_params(trial, method)
+    params = suggest_params(trial, method, prefix)
     # storage[n] = {"fit_score":fscore, 'desc': desc, 'scaling': scaling, 'method': method, **params}
 
     model = get_raw_model(method, params)
@@ -161,16 +490,33 @@ def objective_study(storage, results_detailed, trial, x_dict, y, outdir, method,
         LE = LabelEncoder()
         Y = LE.fit_transform(Y)
 
+    def report_fold(repeat, done, fold_preds):
+        # the score on the folds finished so far is reported, so that the pruner can stop the trial
+        step = repeat*cv_splits + int(round(done.mean()*cv_splits)) - 1
+        obs = np.asarray(Y)[done]
+        if method.endswith('R'):
+            value = r2(obs, fold_preds[done])
+        else:
+            value = balanced_accuracy_score(obs, fold_preds[done])
+        trial.report(value, step)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+        # the timeout is checked between the folds, the worker process is killed
+        # only if a single fold takes much longer
+        if tmout and time.time() - start_time > tmout:
+            raise optuna.TrialPruned()
+
     for r in range(cv_repeats):
         Y = pd.Series(Y)
         X, Y = shuffle(X, Y)
         shuffle_indices = Y.index
 
-        preds = cross_val_predict(model, X, Y, cv=KFold(cv_splits))
+        # for classifiers, the labels and the probabilities come from the same fold models
+        preds, preds_proba = cross_val_fold_predict(model, X, Y, cv_splits, proba=method.endswith('C'),
+                                                    n_jobs=cv_jobs, callback=partial(report_fold, r))
         # if len(y.columns)<2:
         if method.endswith('C'):
             preds = LE.inverse_transform(preds)
-            preds_proba = cross_val_predict(model, X, Y, cv=KFold(cv_splits), method="predict_proba")
             for i, c in enumerate(y.columns):
                 res_pd[c + '.observed'] = y[c]
                 res_pd[c + '.predicted.class.repeat' + str(r + 1)] = pd.Series(preds, index=shuffle_indices).sort_index()
@@ -204,7 +550,8 @@ def objective_study(storage, results_detailed, trial, x_dict, y, outdir, method,
                     'MCC': matthews_corrcoef(Y, fit_preds)}
         fscore = fit_scores["BAC"]
 
-    storage[n] = {"fit_score":fscore, 'desc': desc, 'scaling': scaling, 'method': method, **params}
+    results = {"fit_score": float(fscore), 'desc': desc, 'scaling': scaling, 'method': method, **params}
+    results_store.put(n, 'results', results)
 
     score_df = pd.concat([score_df, pd.DataFrame([fit_scores])], ignore_index=True)   
 
@@ -214,7 +561,7 @@ def objective_study(storage, results_detailed, trial, x_dict, y, outdir, method,
         res_pd.to_csv(os.path.join(outdir, 'trial.' + str(n), 'predictions'), sep=' ',
                       float_format='%.3f', index=False)
         with open(os.path.join(outdir, 'trial.' + str(n), 'parameters.json'), 'w') as param_file:
-            param_output = copy.deepcopy(storage[n])
+            param_output = copy.deepcopy(results)
             param_output["ntrials"] = ntrials
             param_output["cv_splits"] = cv_splits
             param_output["cv_repeats"] = cv_repeats
@@ -223,7 +570,7 @@ def objective_study(storage, results_detailed, trial, x_dict, y, outdir, method,
             param_output["earlystop"] = earlystop
             json.dump(param_output, param_file, indent=4)
     else:
-        results_detailed[n] = {'score': score_df, 'predictions': res_pd}
+        results_store.put(n, 'detailed', {'score': score_df, 'predictions': res_pd})
 
     if method.endswith('R'):
         score = np.mean(score_df[score_df['stat'].str.contains('consensus')].R2)
@@ -232,44 +579,430 @@ def objective_study(storage, results_detailed, trial, x_dict, y, outdir, method,
     return score
 
 
-def run_objective_study_with_timeout(storage, results_detailed, x_dict, y, outdir, method, ntrials,
-                                     cv_splits, cv_repeats, jobs, tmout, earlystop, write_output, trial):
-    timeouted_objective = timeout_decorator.timeout(tmout, timeout_exception=optuna.TrialPruned, use_signals=False)(objective_study)
-    return timeouted_objective(storage, results_detailed, trial, x_dict, y, outdir, method, ntrials,
-                               cv_splits, cv_repeats, jobs, tmout, earlystop, write_output)
-
-
-def launch_study(x_dict, y, outdir, method, ntrials, cv_splits, cv_repeats, jobs, tmout, earlystop, write_output: bool = True):
-    manager = Manager()
-    results_dict = manager.dict()
-    results_detailed = manager.dict()
-
-    study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler())
-    kwargs_opt = {'callbacks':[TopNPatienceCallback(earlystop[0], earlystop[1])]} if earlystop[0] > 0 else {}
-    study.optimize(partial(run_objective_study_with_timeout, results_dict, results_detailed, x_dict, y, outdir, method, ntrials,
-                           cv_splits, cv_repeats, jobs, tmout, earlystop, write_output),
-                   n_trials=ntrials, n_jobs=jobs, catch=(TimeoutError,), **kwargs_opt)
-    
-    hyperparam_names = list(results_dict[next(iter(results_dict))].keys())
-
-    results_pd = pd.DataFrame(columns=['trial']+hyperparam_names+['score'])
-    intermediate = study.trials_dataframe(attrs=('number', 'value'))
-    
-    for i, row in intermediate.iterrows():
-        number = int(row.number)
-        if number not in results_dict:
+def run_objective_study(results_store, x_dict, y, outdir, method, ntrials,
+                        cv_splits, cv_repeats, jobs, tmout, earlystop, write_output, cv_jobs, trial):
+    try:
+        return objective_study(results_store, trial, x_dict, y, outdir, method, ntrials,
+                               cv_splits, cv_repeats, jobs, tmout, earlystop, write_output, cv_jobs)
+    finally:
+        # the results are kept with the trial, so that the results table can be restored
+        # from a persistent storage
+        record = results_store.get(trial.number)
+        if 'results' in record:
+            trial.set_user_attr('results', record['results'])
+
+
+def get_pruner(pruner, n_steps):
+    """
+    Returns the Optuna pruner by its name. n_steps is the number of
+    intermediate scores reported by a trial (cv_splits*cv_repeats).
+    """
+    if pruner is None or pruner == 'none':
+        return optuna.pruners.NopPruner()
+    elif pruner == 'median':
+        return optuna.pruners.MedianPruner(n_startup_trials=5)
+    elif pruner == 'halving':
+        return optuna.pruners.SuccessiveHalvingPruner()
+    elif pruner == 'hyperband':
+        return optuna.pruners.HyperbandPruner(min_resource=1, max_resource=n_steps)
+    else:
+        raise ValueError("Unknown pruner "+pruner+". Allowed values: none, median, halving, hyperband")
+
+
+# interval (sec) of the heartbeat of the running trials in the database storages
+_heartbeat_interval = 60
+
+
+def get_storage(storage, outdir):
+    """
+    Returns the Optuna storage of the study. "sqlite" and "journal" create
+    the storage file in the output directory (the journal file is safer on
+    shared network filesystems), a path ending with ".log" is used as a
+    journal file, any other string is used as a database URL. If storage is
+    None, the study is kept in memory.
+
+    The database storages record a heartbeat of the running trials: the
+    trials of a crashed process are marked as failed and run again with
+    the same parameters.
+    """
+    if storage is None or storage == 'memory':
+        return None
+    elif storage == 'journal':
+        return JournalStorage(JournalFileBackend(os.path.join(outdir, 'study.log')))
+    elif storage.endswith('.log'):
+        return JournalStorage(JournalFileBackend(storage))
+    if storage == 'sqlite':
+        storage = 'sqlite:///' + os.path.abspath(os.path.join(outdir, 'study.db'))
+    return RDBStorage(storage, heartbeat_interval=_heartbeat_interval,
+                      failed_trial_callback=RetryFailedTrialCallback(max_retry=1))
+
+
+def _fail_stale_trials(study, storage, tmout):
+    """
+    Marks as failed the trials left running by a crashed process and
+    enqueues their parameters again. The database storages use the
+    heartbeat, for the journal file the trials running for longer than
+    the timeout with its grace period are taken, as their worker would
+    have been killed by then. Without a timeout, they cannot be told
+    from the trials running in other processes and are kept.
+    """
+    if isinstance(storage, RDBStorage):
+        optuna.storages.fail_stale_trials(study)
+    elif isinstance(storage, JournalStorage) and tmout:
+        study_id = storage.get_study_id_from_name(study.study_name)
+        for t in study.get_trials(deepcopy=False, states=(TrialState.RUNNING,)):
+            if time.time() - t.datetime_start.timestamp() > tmout*_timeout_grace:
+                trial_id = storage.get_trial_id_from_study_id_trial_number(study_id, t.number)
+                storage.set_trial_state_values(trial_id, TrialState.FAIL)
+                study.enqueue_trial(t.params)
+
+
+def _trial_worker(slot, current, started, errors, stop, storage, study_name, pruner, results_file, study_args):
+    outdir, ntrials, cv_splits, cv_repeats = study_args[2], study_args[4], study_args[5], study_args[6]
+    study = optuna.load_study(study_name=study_name, storage=get_storage(storage, outdir),
+                              sampler=optuna.samplers.TPESampler(), pruner=get_pruner(pruner, cv_splits*cv_repeats))
+    results_store = FileResultStore(results_file)
+
+    def objective(trial):
+        # the main process kills the worker if the trial runs far over the timeout
+        started[slot] = time.time()
+        current[slot] = trial.number
+        local_store = MemoryResultStore()
+        try:
+            return run_objective_study(local_store, *study_args, trial)
+        finally:
+            current[slot] = -1
+            record = local_store.get(trial.number)
+            if 'detailed' in record:
+                results_store.put(trial.number, 'detailed', record['detailed'])
+
+    def stop_callback(study, trial):
+        # set by the main process when the study is stopped early
+        if stop.is_set():
+            study.stop()
+
+    # the trials running in the other workers are counted, so that the study does not run more than ntrials
+    if stop.is_set() or len(study.get_trials(deepcopy=False, states=_counted_states)) >= ntrials:
+        return
+    callbacks = [MaxTrialsCallback(ntrials, states=_counted_states), stop_callback]
+    try:
+        study.optimize(objective, n_trials=ntrials, callbacks=callbacks)
+    except Exception as e:
+        # the error is raised again in the main process
+        try:
+            errors.put(e)
+        except Exception:
+            pass
+        raise
+
+
+class _PatienceMonitor:
+    """
+    Feeds the trials of a study, in the order in which they finish, to a
+    TopNPatienceCallback. Only the new trials and those not finished at the
+    previous poll are read from the storage, at most once per interval.
+    """
+    def __init__(self, storage, study_id, earlystop, interval=1.):
+        self.storage = storage
+        self.study_id = study_id
+        self.interval = interval
+        self.callback = TopNPatienceCallback(earlystop[0], earlystop[1])
+        self._direction = storage.get_study_directions(study_id)[0]
+        # the trials of a resumed study finished before the start are not taken
+        trials = storage.get_all_trials(study_id, deepcopy=False)
+        self._n_trials = len(trials)
+        self._pending = [storage.get_trial_id_from_study_id_trial_number(study_id, t.number)
+                         for t in trials if t.state not in _finished_states]
+        self._last_poll = 0.
+
+    def poll(self):
+        """
+        Returns True if the study should be stopped.
+        """
+        if time.time() - self._last_poll < self.interval:
+            return self.callback.should_stop
+        self._last_poll = time.time()
+        while True:
+            try:
+                self._pending.append(self.storage.get_trial_id_from_study_id_trial_number(self.study_id,
+                                                                                          self._n_trials))
+            except KeyError:
+                break
+            self._n_trials += 1
+        pending = []
+        for trial_id in self._pending:
+            trial = self.storage.get_trial(trial_id)
+            if trial.state in _finished_states:
+                self.callback.update(trial, self._direction)
+            else:
+                pending.append(trial_id)
+        self._pending = pending
+        return self.callback.should_stop
+
+
+def _optimize_in_processes(storage, study_name, pruner, results_file, jobs, study_args):
+    """
+    Runs the trials in jobs worker processes. Each worker keeps the
+    descriptors in memory (on fork, shared with the main process until
+    modified) and takes the trials from the shared storage. The trials
+    stop themselves at the timeout between the CV folds; a worker running
+    a trial over the timeout plus a grace period is killed, its trial is
+    marked as pruned and a new worker is started in its place. If a worker
+    fails, the other workers are stopped and its error is raised.
+
+    With early stopping, the trials finished by the workers are given to one
+    TopNPatienceCallback here; when it fires, the workers finish their
+    current trials and do not start new ones.
+    """
+    outdir, ntrials, tmout, earlystop = study_args[2], study_args[4], study_args[8], study_args[9]
+    ctx = mp.get_context()
+    current = ctx.Array('l', [-1]*jobs, lock=False)
+    started = ctx.Array('d', [0.]*jobs, lock=False)
+    errors = ctx.SimpleQueue()
+    stop = ctx.Event()
+    main_storage = optuna.storages.get_storage(get_storage(storage, outdir))
+    study_id = main_storage.get_study_id_from_name(study_name)
+    patience = _PatienceMonitor(main_storage, study_id, earlystop) if earlystop[0] > 0 else None
+
+    def start_worker(slot):
+        worker = ctx.Process(target=_trial_worker, args=(slot, current, started, errors, stop, storage, study_name,
+                                                         pruner, results_file, study_args))
+        worker.start()
+        return worker
+
+    workers = {slot: start_worker(slot) for slot in range(jobs)}
+    while workers:
+        time.sleep(0.1)
+        if patience is not None and not stop.is_set() and patience.poll():
+            stop.set()
+        for slot, worker in list(workers.items()):
+            if not worker.is_alive():
+                del workers[slot]
+                if worker.exitcode != 0:
+                    for other_slot, other in workers.items():
+                        other.kill()
+                        other.join()
+                        if current[other_slot] >= 0:
+                            trial_id = main_storage.get_trial_id_from_study_id_trial_number(study_id, current[other_slot])
+                            main_storage.set_trial_state_values(trial_id, TrialState.FAIL)
+                    if not errors.empty():
+                        raise errors.get()
+                    raise RuntimeError("Optimization worker process failed with exit code {}".format(worker.exitcode))
+            elif tmout and current[slot] >= 0 and time.time() - started[slot] > tmout*_timeout_grace:
+                worker.kill()
+                worker.join()
+                if current[slot] >= 0:
+                    trial_id = main_storage.get_trial_id_from_study_id_trial_number(study_id, current[slot])
+                    main_storage.set_trial_state_values(trial_id, TrialState.PRUNED)
+                    current[slot] = -1
+                if not stop.is_set() and \
+                        len(main_storage.get_all_trials(study_id, deepcopy=False, states=_counted_states)) < ntrials:
+                    workers[slot] = start_worker(slot)
+                else:
+                    del workers[slot]
+
+
+def trials_table(trials):
+    """
+    Returns the table of the results of the given trials (from the
+    "results" user attributes), the latest trial first.
+    """
+    columns = {'trial': []}
+    for i, t in enumerate(trials):
+        row = {'trial': t.number, **t.user_attrs['results']}
+        for k, v in row.items():
+            # the columns absent in the previous rows are filled with None
+            columns.setdefault(k, [None]*i).append(v)
+        for k, values in columns.items():
+            if len(values) == i:
+                values.append(None)
+    for k, values in columns.items():
+        if None in values:
+            # keeps the integer parameters of one method integer when the other methods do not have them
+            columns[k] = pd.Series(values, dtype=object)
+    columns['score'] = [t.value for t in trials]
+    return pd.DataFrame(columns).iloc[::-1].reset_index(drop=True)
+
+
+def _parquet_table(table):
+    """
+    Returns the trials table with the columns mixing strings and numbers
+    (e.g., max_features of the random forests) converted to strings, as
+    Parquet columns have a single type. The missing values are kept.
+    """
+    table = table.copy()
+    for c in table.columns[table.dtypes == object]:
+        types = {type(v) for v in table[c] if v is not None and not pd.isnull(v)}
+        if str in types and len(types) > 1:
+            table[c] = pd.Series([v if v is None or pd.isnull(v) else str(v) for v in table[c]],
+                                 index=table.index, dtype=object)
+    return table
+
+
+class _SearchSpace:
+    """
+    Stands in for a trial in suggest_params: the distribution of each
+    parameter is recorded, and the name of the parameter is returned in
+    place of its value.
+    """
+    def __init__(self):
+        self.distributions = {}
+
+    def suggest_float(self, name, low, high, *, step=None, log=False):
+        self.distributions[name] = FloatDistribution(low, high, step=step, log=log)
+        return name
+
+    def suggest_int(self, name, low, high, *, step=1, log=False):
+        self.distributions[name] = IntDistribution(low, high, step=step, log=log)
+        return name
+
+    def suggest_categorical(self, name, choices):
+        self.distributions[name] = CategoricalDistribution(choices)
+        return name
+
+
+def _in_distribution(distribution, value):
+    if isinstance(distribution, CategoricalDistribution):
+        return value in distribution.choices
+    return isinstance(value, (int, float)) and distribution.low <= value <= distribution.high
+
+
+def warm_start_params(files, x_dict, method):
+    """
+    Reads the trials of previous studies from trials.all or parameters.json
+    files (or the output directories containing trials.all) and converts them to the parameters of the current study, to be
+    enqueued. The trials from parameters.json files come first, followed by
+    the trials.all rows ordered by score. The trials with a descriptor space
+    or a method absent in the current study are skipped, as well as the
+    parameter values outside of the current search space.
+    """
+    methods = [method] if isinstance(method, str) else list(method)
+    records = []
+    for f in files:
+        if os.path.isdir(f):
+            f = os.path.join(f, 'trials.all')
+        if f.endswith('.json'):
+            with open(f) as param_file:
+                records.append((np.inf, json.load(param_file)))
+        else:
+            # read as text, so that the integer parameters are not converted to float by the missing values
+            table = pd.read_table(f, sep=' ', dtype=str)
+            scores = pd.to_numeric(table['score'], errors='coerce').fillna(-np.inf)
+            for score, row in zip(scores, table.to_dict('records')):
+                records.append((score, {k: _parse_value(v) for k, v in row.items() if not pd.isnull(v)}))
+    records.sort(key=lambda r: r[0], reverse=True)
+
+    warm_params = []
+    for _, record in records:
+        if record.get('desc') not in x_dict or record.get('method') not in methods:
             continue
-        added_row = {'trial': number, 'score': row.value, 'fit_score': results_dict[number]["fit_score"]}
-        for hp in hyperparam_names:
-            added_row[hp] = results_dict[number][hp]
+        # the parameters are named as in objective_study
+        prefix = record['method'] + '_' if not isinstance(method, str) else ''
+        space = _SearchSpace()
+        names = suggest_params(space, record['method'], prefix)
+        params = {'desc_type': record['desc']}
+        if record.get('scaling') in ('maxabs', 'original'):
+            params['scaling'] = record['scaling']
+        elif record.get('scaling') == 'scaled':
+            # the min-max scaled trials of the previous versions are evaluated with max-abs scaling
+            params['scaling'] = 'maxabs'
+        if not isinstance(method, str):
+            params['method'] = record['method']
+        for k, name in names.items():
+            if k in record and _in_distribution(space.distributions[name], record[k]):
+                params[name] = record[k]
+        if params not in warm_params:
+            warm_params.append(params)
+    return warm_params
+
+
+def launch_study(x_dict, y, outdir, method, ntrials, cv_splits, cv_repeats, jobs, tmout, earlystop, write_output: bool = True,
+                 cv_jobs: int = 1, pruner: str = 'none', storage: str = None, parquet: bool = False, screen: int = 0,
+                 warm_start=None, warm_trials: int = 10, study_name: str = None):
+    """
+    Runs the hyperparameter optimization study. method may be a list of
+    methods of the same task, which are then optimized jointly, the
+    method being a categorical parameter of the study. If screen is given,
+    only the screen best descriptor spaces according to screen_descriptors
+    are optimized. warm_start is a list of trials.all or parameters.json
+    files of previous studies, the warm_trials best of which are evaluated
+    first. The study is named after the output directory, unless study_name
+    is given.
+    """
+    if not isinstance(method, str) and len(method) == 1:
+        # a single method is optimized with the parameter names of a single-method study
+        method = method[0]
+    if not isinstance(method, str) and len(set(m[-1] for m in method)) > 1:
+        raise ValueError("Regression and classification methods cannot be optimized together")
+    if parquet and not _parquet_available:
+        raise ImportError("Saving the trials in Parquet format requires pyarrow or fastparquet")
+    if 0 < screen < len(x_dict):
+        screening = screen_descriptors(x_dict, y, method if isinstance(method, str) else method[0], n_jobs=jobs)
+        if write_output:
+            screening.to_csv(os.path.join(outdir, 'descriptors.screening'), sep=' ', index_label='desc')
+        x_dict = {desc: x_dict[desc] for desc in screening.index[:screen]}
+        # the worker processes inherit the cache, the dropped spaces are not used by the trials
+        _drop_cached_descriptors(x_dict)
+    temporary_files = []
+    if (tmout or jobs > 1) and get_storage(storage, outdir) is None:
+        # the worker processes share the study through a temporary journal file
+        storage = _temporary_file('.log')
+        temporary_files.append(storage)
+    if tmout or jobs > 1:
+        # the trials are run by worker processes, which can be killed on timeout
+        results_store = FileResultStore(_temporary_file('.results'))
+        temporary_files.append(results_store.path)
+    else:
+        results_store = MemoryResultStore()
+
+    # the study is named after the output directory, so that relaunching with the same
+    # output directory (or from another node sharing the storage) continues the same study
+    if study_name is None:
+        study_name = os.path.basename(os.path.abspath(outdir))
+    study_storage = get_storage(storage, outdir)
+    study = optuna.create_study(direction="maximize", sampler=optuna.samplers.TPESampler(),
+                                pruner=get_pruner(pruner, cv_splits*cv_repeats),
+                                storage=study_storage,
+                                study_name=study_name,
+                                load_if_exists=True)
+    _fail_stale_trials(study, study_storage, tmout)
+    if warm_start:
+        # the trials already run or enqueued in a resumed study are not enqueued again
+        for params in warm_start_params(warm_start, x_dict, method)[:warm_trials]:
+            study.enqueue_trial(params, skip_if_exists=True)
+    study_args = (x_dict, y, outdir, method, ntrials, cv_splits, cv_repeats, jobs, tmout, earlystop, write_output, cv_jobs)
+    callbacks = [MaxTrialsCallback(ntrials, states=_finished_states)]
+    if earlystop[0] > 0:
+        callbacks.append(TopNPatienceCallback(earlystop[0], earlystop[1]))
+    try:
+        if len(study.get_trials(deepcopy=False, states=_finished_states)) < ntrials:
+            if tmout or jobs > 1:
+                _optimize_in_processes(storage, study_name, pruner, results_store.path, jobs, study_args)
+            else:
+                study.optimize(partial(run_objective_study, results_store, *study_args),
+                               n_trials=ntrials, callbacks=callbacks)
+        results_detailed = {n: results_store.get(n)['detailed'] for n in results_store.numbers()
+                            if 'detailed' in results_store.get(n)}
+
+        # the results of the previous runs of the study are kept in the trials attributes
+        completed = [t for t in study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,))
+                     if 'results' in t.user_attrs]
+    finally:
+        for f in temporary_files:
+            os.remove(f)
+
+    results_pd = trials_table(completed)
 
-        results_pd = pd.concat([pd.DataFrame([added_row]), results_pd.loc[:]]).reset_index(drop=True)
-    
     if write_output:
-        results_pd.to_csv(os.path.join(outdir,'trials.all'), sep=' ', index=False)
-        results_pd.sort_values(by='score', ascending=False).head(50).to_csv(os.path.join(outdir,'trials.best'), sep=' ', index=False)
+        # the parameters absent for a trial (those of the other methods) are written as None,
+        # so that the tables can be read with any whitespace as the separator
+        results_pd.to_csv(os.path.join(outdir,'trials.all'), sep=' ', index=False, na_rep='None')
+        results_pd.nlargest(50, 'score').to_csv(os.path.join(outdir,'trials.best'), sep=' ', index=False, na_rep='None')
+        if parquet:
+            _parquet_table(results_pd).to_parquet(os.path.join(outdir, 'trials.parquet'), index=False)
     else:
         return results_pd, results_detailed
 
 
-__all__ = ['calculate_scores', 'collect_data', 'launch_study']
+__all__ = ['calculate_scores', 'collect_data', 'get_pruner', 'get_storage', 'launch_study', 'screen_descriptors',
+           'trials_table', 'warm_start_params']
@@ -31,6 +31,7 @@ from sklearn.datasets import dump_svmlight_file
 from doptools.chem.chem_features import ComplexFragmentor, PassThrough
 from doptools.chem.solvents import SolventVectorizer
 from doptools.optimizer.config import get_raw_calculator
+from doptools.optimizer.utils import save_descriptors
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 warnings.simplefilter(action='ignore', category=DeprecationWarning)
@@ -227,6 +228,10 @@ def output_descriptors(calculated_result, output_params):
             if output_params['format'] == 'csv':
                 desc = pd.concat([pd.Series(d['property'], name=d['name']), d['table']], axis=1, sort=False)
                 desc.to_csv(output_name, index=False)
+            elif output_params['format'] == 'csr':
+                save_descriptors(output_name, d['table'], d['property'],
+                                 metadata={'property': d['name'], 'descriptor': desc_name,
+                                           'calculator': type(d['calculator']).__name__})
             else:
                 dump_svmlight_file(d['table'].astype(float), d['property'], output_name, zero_based=False)
 
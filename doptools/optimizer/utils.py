@@ -16,7 +16,13 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program; if not, see <https://www.gnu.org/licenses/>.
 
+import json
+import os
+
 import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from sklearn.datasets import load_svmlight_file
 
 
 def r2(a, b):
@@ -27,4 +33,66 @@ def rmse(a, b):
     return np.sqrt(np.sum((a-b)**2)/len(a))
 
 
-__all__ = ['r2', 'rmse']
+def _parse_value(value):
+    # the parameters read as text from trials.all are converted back to numbers where possible
+    for t in (int, float):
+        try:
+            return t(value)
+        except ValueError:
+            pass
+    return value
+
+
+def save_descriptors(path, table, y=None, feature_names=None, metadata=None):
+    """
+    Saves the descriptor table in the binary CSR format: a folder (by
+    convention with .csr extension) containing the data, indices and indptr
+    arrays and the property values as .npy files, and meta.json with the
+    shape, the feature names and the metadata (e.g., calculator parameters).
+    """
+    if isinstance(table, pd.DataFrame):
+        if feature_names is None:
+            feature_names = [str(c) for c in table.columns]
+        table = table.to_numpy()
+    X = csr_matrix(table, dtype=np.float32)
+    X.sort_indices()
+    index_dtype = np.int32 if X.nnz < np.iinfo(np.int32).max else np.int64
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'data.npy'), X.data)
+    np.save(os.path.join(path, 'indices.npy'), X.indices.astype(index_dtype))
+    np.save(os.path.join(path, 'indptr.npy'), X.indptr.astype(index_dtype))
+    if y is not None:
+        np.save(os.path.join(path, 'y.npy'), np.asarray(y))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'shape': list(X.shape), 'feature_names': feature_names,
+                   'metadata': metadata if metadata is not None else {}}, f, indent=4)
+
+
+def load_descriptors(path, mmap=True):
+    """
+    Loads the descriptors saved by save_descriptors. Returns the CSR matrix,
+    the property values (None if not saved) and the content of meta.json.
+    The arrays are memory-mapped unless mmap is False, so the loading is
+    instant and the processes reading the same files share the page cache.
+    """
+    mmap_mode = 'r' if mmap else None
+    arrays = [np.load(os.path.join(path, a + '.npy'), mmap_mode=mmap_mode) for a in ('data', 'indices', 'indptr')]
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    X = csr_matrix(tuple(arrays), shape=tuple(meta['shape']), copy=False)
+    y = np.load(os.path.join(path, 'y.npy')) if os.path.exists(os.path.join(path, 'y.npy')) else None
+    return X, y, meta
+
+
+def load_descriptor_file(path):
+    """
+    Returns the descriptors and property values from either a binary CSR
+    descriptor folder (.csr) or a svmlight file.
+    """
+    if os.path.normpath(path).endswith('.csr'):
+        X, y, _ = load_descriptors(path)
+        return X, y
+    return load_svmlight_file(path)
+
+
+__all__ = ['load_descriptor_file', 'load_descriptors', 'r2', 'rmse', 'save_descriptors']
@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from sklearn.base import clone
+from sklearn.linear_model import LinearRegression, Ridge
+from sklearn.pipeline import Pipeline
+
+from doptools.chem.chem_features import ChythonCircus, ChythonCircusNonhash
+from doptools.estimators.ad_estimators import BoundingBox, FragmentControl, Leverage, PipelineWithAD, TanimotoKNN
+
+
+def count_matrix(n, m, seed, density=0.3, offset=0):
+    rng = np.random.default_rng(seed)
+    return (rng.integers(1, 5, (n, m))*(rng.random((n, m)) < density) + offset).astype(float)
+
+
+def test_bounding_box_counts_violations_as_loop():
+    train = count_matrix(50, 12, 0)
+    # a column that is never zero in the training set, so that the zeros of the queries violate it
+    train[:, 3] += 6
+    test = count_matrix(30, 12, 1, density=0.5)*2 - 1
+    bb = BoundingBox([None]).fit(None, descriptors=csr_matrix(train))
+
+    expected = [sum(1 for j in range(train.shape[1])
+                    if row[j] < train[:, j].min() or row[j] > train[:, j].max()) for row in test]
+    assert list(bb.count_violations(None, csr_matrix(test))) == expected
+    assert list(bb.count_violations(None, test)) == expected
+
+
+def test_bounding_box_pads_missing_columns():
+    train = count_matrix(40, 8, 2)
+    train[:, -1] = 0
+    bb = BoundingBox([None]).fit(None, descriptors=csr_matrix(train[:, :-1]))
+    test = count_matrix(10, 8, 3)
+    test[:, -1] = 1
+    # the last column, zero for all training samples, is violated by all queries
+    assert list(bb.count_violations(None, csr_matrix(test))) == \
+        list(BoundingBox([None]).fit(None, descriptors=train).count_violations(None, test))
+
+
+@pytest.mark.parametrize('calculator', [ChythonCircus, ChythonCircusNonhash])
+def test_fragment_control_finds_unseen_fragments(calculator):
+    train = ['CCO', 'CCCO', 'CCN', 'OCCN']
+    test = ['CCCN', 'CCCl', 'OCCO']
+    fragmentor = calculator(lower=0, upper=1, fmt='smiles')
+    pipeline = Pipeline([('frag', fragmentor), ('model', LinearRegression())])
+    fc = FragmentControl(pipeline).fit(train, [1., 2., 3., 4.])
+
+    unseen = fc.unseen_fragments(test)
+    assert unseen[0] == [] and unseen[2] == []
+    assert unseen[1] and all('Cl' in f for f in unseen[1])
+    assert fc.predict(test) == [1, -1, 1]
+    # the fragmentor is queried, not refitted
+    assert fc.fragmentor.get_feature_names() == pipeline[0].get_feature_names()
+
+
+def test_fragment_control_refits_fragmentors_without_unseen_query():
+    class Fragmentor(ChythonCircusNonhash):
+        def __getattribute__(self, name):
+            if name == 'get_unseen_fragments':
+                raise AttributeError(name)
+            return super().__getattribute__(name)
+
+    pipeline = Pipeline([('frag', Fragmentor(lower=0, upper=1, fmt='smiles')), ('model', LinearRegression())])
+    fc = FragmentControl(pipeline).fit(['CCO', 'CCN'], [1., 2.])
+    assert fc.predict(['NCCO', 'CCCl']) == [1, -1]
+    assert fc.fragmentor.get_feature_names() == pipeline[0].get_feature_names()
+
+
+@pytest.mark.parametrize('ad_type', ['FragmentControl', 'BoundingBox', 'Leverage'])
+def test_pipeline_with_ad_predicts_in_chunks(ad_type):
+    train = ['CCO', 'CCCO', 'CCN', 'OCCN', 'CCCC', 'CC(C)O', 'NCCCO']
+    y = np.arange(len(train), dtype=float)
+    test = ['CCCN', 'CCCl', 'OCCO', 'CCCCCCO', 'ClCCl', 'CC(O)CN', 'CO']
+    pipeline = Pipeline([('frag', ChythonCircus(lower=0, upper=1, fmt='smiles')), ('model', Ridge())])
+
+    whole = PipelineWithAD(clone(pipeline), ad_type, chunk_size=1000).fit(train, y).predict(test)
+    chunked = PipelineWithAD(clone(pipeline), ad_type, chunk_size=3).fit(train, y).predict(test)
+    assert len(chunked) == len(test)
+    np.testing.assert_allclose(chunked['Predicted'], whole['Predicted'])
+    np.testing.assert_array_equal(chunked['AD'], whole['AD'])
+    np.testing.assert_allclose(whole['Predicted'], pipeline.fit(train, y).predict(test))
+    assert PipelineWithAD(clone(pipeline), ad_type).fit(train, y).predict([]).empty
+
+
+def tanimoto_top(train, test, k):
+    dot = test @ train.T
+    union = (test**2).sum(axis=1)[:, None] + (train**2).sum(axis=1)[None, :] - dot
+    similarity = np.divide(dot, union, out=np.zeros_like(dot), where=union > 0)
+    return -np.sort(-similarity, axis=1)[:, :k]
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_tanimoto_knn_matches_brute_force(binary):
+    train, test = count_matrix(200, 70, 4), count_matrix(40, 70, 5)
+    if binary:
+        train, test = (train > 0).astype(float), (test > 0).astype(float)
+    knn = TanimotoKNN([None], k=3).fit(None, descriptors=csr_matrix(train))
+    assert knn.binary_ == binary
+    np.testing.assert_allclose(knn.kneighbors_similarity(None, csr_matrix(test)), tanimoto_top(train, test, 3))
+
+
+def test_tanimoto_knn_query_blocks():
+    train, test = count_matrix(100, 30, 6), count_matrix(25, 30, 7)
+    knn = TanimotoKNN([None], k=2).fit(None, descriptors=csr_matrix(train))
+    blocks = list(knn._blocks(csr_matrix(test), max_products=200))
+    assert blocks[0][0] == 0 and blocks[-1][1] == len(test)
+    assert all(first < last for first, last in blocks)
+    assert all(a[1] == b[0] for a, b in zip(blocks, blocks[1:]))
+
+
+def test_leverage_matches_hat_matrix():
+    rng = np.random.default_rng(8)
+    train, test = rng.random((100, 6)), rng.random((20, 6))
+    lev = Leverage([None]).fit(None, descriptors=train)
+    inverse = np.linalg.pinv(train.T @ train)
+    np.testing.assert_allclose(lev.leverage(None, test), np.einsum('ij,jk,ik->i', test, inverse, test))
+    assert lev.threshold_ == pytest.approx(3*(6+1)/100)
+
+
+def test_leverage_truncated_for_sparse_input():
+    train = csr_matrix(count_matrix(200, 500, 9, density=0.05))
+    lev = Leverage([None]).fit(None, descriptors=train)
+    assert lev.n_components_ == 20
+    assert lev.threshold_ < 1
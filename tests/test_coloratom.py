@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+from doptools.chem.coloratom import ContributionStatistics
+
+
+def accumulate(values):
+    stats = ContributionStatistics()
+    for key, value in values:
+        stats._add(key, 1, value, 0.)
+    return stats
+
+
+def contributions(seed, n=300):
+    rng = np.random.default_rng(seed)
+    return [('frag'+str(k), float(v)) for k, v in zip(rng.integers(0, 5, n), rng.normal(1., 2., n))]
+
+
+def test_running_statistics_match_numpy():
+    values = contributions(0)
+    summary = accumulate(values).summary().set_index('fragment')
+    for key in summary.index:
+        x = np.array([v for k, v in values if k == key])
+        assert summary.loc[key, 'count'] == len(x)
+        assert summary.loc[key, 'mean'] == pytest.approx(x.mean())
+        assert summary.loc[key, 'std'] == pytest.approx(x.std(ddof=1) if len(x) > 1 else 0.)
+    assert list(summary['abs_mean']) == sorted(summary['abs_mean'], reverse=True)
+
+
+def test_merge_equals_single_pass():
+    first, second = contributions(1), contributions(2)
+    merged = accumulate(first).merge(accumulate(second)).summary().set_index('fragment').sort_index()
+    single = accumulate(first + second).summary().set_index('fragment').sort_index()
+    assert list(merged['count']) == list(single['count'])
+    np.testing.assert_allclose(merged[['mean', 'std']].to_numpy(), single[['mean', 'std']].to_numpy())
+
+
+def test_merge_requires_same_radius():
+    with pytest.raises(ValueError):
+        ContributionStatistics(radius=1).merge(ContributionStatistics(radius=2))
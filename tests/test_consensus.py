@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+from sklearn.base import clone
+from sklearn.linear_model import Ridge
+from sklearn.pipeline import Pipeline
+from sklearn.svm import SVR
+
+from doptools.chem.chem_features import ChythonCircus
+from doptools.estimators.consensus import ConsensusModel
+
+TRAIN = ['CCO', 'CCCO', 'CCN', 'OCCN', 'CCCC', 'CC(C)O', 'NCCCO', 'CCOC']
+TEST = ['CCCN', 'OCCO', 'CCCCCCO', 'CC(O)CN', 'CO']
+Y = np.arange(len(TRAIN), dtype=float)
+
+
+class CountingCircus(ChythonCircus):
+    calls = {'fit': 0, 'transform': 0}
+
+    def fit(self, X, y=None):
+        CountingCircus.calls['fit'] += 1
+        return super().fit(X, y)
+
+    def transform(self, X, y=None):
+        CountingCircus.calls['transform'] += 1
+        return super().transform(X, y)
+
+
+def members():
+    return [Pipeline([('frag', CountingCircus(lower=0, upper=1, fmt='smiles')), ('model', Ridge(alpha=a))])
+            for a in (0.1, 1.0)] + \
+           [Pipeline([('frag', CountingCircus(lower=0, upper=2, fmt='smiles')), ('model', SVR())])]
+
+
+@pytest.fixture(autouse=True)
+def reset_calls():
+    CountingCircus.calls.update(fit=0, transform=0)
+
+
+def test_consensus_predict_shares_descriptors():
+    fitted = [p.fit(TRAIN, Y) for p in members()]
+    expected = np.array([p.predict(TEST) for p in fitted]).T
+    CountingCircus.calls.update(fit=0, transform=0)
+
+    for n_jobs in (1, 2):
+        res = ConsensusModel(fitted, n_jobs=n_jobs).predict(TEST, output='preds')
+        np.testing.assert_allclose(res.values, expected)
+    # the two members with the same fragmentor share one descriptor table per call
+    assert CountingCircus.calls['transform'] == 4
+
+
+@pytest.mark.parametrize('backend', ['threading', 'loky'])
+def test_consensus_fit_shares_descriptors(backend):
+    expected = np.array([p.fit(TRAIN, Y).predict(TEST) for p in members()]).T
+    CountingCircus.calls.update(fit=0, transform=0)
+
+    model = ConsensusModel(members(), n_jobs=2, backend=backend).fit(TRAIN, Y)
+    assert CountingCircus.calls['fit'] == 2
+    np.testing.assert_allclose(model.predict(TEST, output='preds').values, expected)
+    res = model.predict(TEST)
+    np.testing.assert_allclose(res['Pred.Avg.'], expected.mean(axis=1))
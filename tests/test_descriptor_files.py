@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+from sklearn.datasets import dump_svmlight_file
+
+from doptools.cli.ensemble_model_rebuilding import create_model_folder
+from doptools.optimizer.optimizer import collect_data
+from doptools.optimizer.utils import load_descriptor_file, load_descriptors, save_descriptors
+
+
+def descriptor_table(seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.integers(1, 6, (30, 15))*(rng.random((30, 15)) < 0.3)
+    return pd.DataFrame(values, columns=['frag'+str(i) for i in range(15)]), rng.random(30)
+
+
+def test_csr_round_trip(tmp_path):
+    table, y = descriptor_table()
+    path = str(tmp_path / 'prop.circus_0_2.csr')
+    save_descriptors(path, table, y, metadata={'lower': 0, 'upper': 2})
+
+    for mmap in (True, False):
+        X, y_loaded, meta = load_descriptors(path, mmap=mmap)
+        np.testing.assert_array_equal(X.toarray(), table.to_numpy())
+        np.testing.assert_array_equal(y_loaded, y)
+        assert meta['feature_names'] == list(table.columns)
+        assert meta['metadata'] == {'lower': 0, 'upper': 2}
+
+
+def test_load_descriptor_file_formats(tmp_path):
+    table, y = descriptor_table(1)
+    save_descriptors(str(tmp_path / 'prop.desc.csr'), table, y)
+    dump_svmlight_file(table.to_numpy(), y, str(tmp_path / 'prop.desc.svm'), zero_based=False)
+
+    X_csr, y_csr = load_descriptor_file(str(tmp_path / 'prop.desc.csr'))
+    X_svm, y_svm = load_descriptor_file(str(tmp_path / 'prop.desc.svm'))
+    n_features = X_svm.shape[1]
+    np.testing.assert_array_equal(X_csr.toarray()[:, :n_features], X_svm.toarray())
+    np.testing.assert_allclose(y_csr, y_svm)
+
+
+def test_model_folder_copies_csr_descriptors(tmp_path):
+    table, y = descriptor_table(2)
+    desc_folder, outdir = tmp_path / 'descs', tmp_path / 'model'
+    desc_folder.mkdir()
+    outdir.mkdir()
+    save_descriptors(str(desc_folder / 'prop.kept.csr'), table, y)
+    save_descriptors(str(desc_folder / 'prop.dropped.csr'), table, y)
+    dump_svmlight_file(table.to_numpy(), y, str(desc_folder / 'prop.other.svm'), zero_based=False)
+
+    create_model_folder(str(desc_folder), str(outdir), pd.DataFrame({'desc': ['kept', 'other']}),
+                        pd.DataFrame({'prop': y}), None)
+    assert sorted(p.name for p in outdir.iterdir()) == ['prop.kept.csr', 'prop.other.svm', 'training_set.csv']
+    X, _ = load_descriptor_file(str(outdir / 'prop.kept.csr'))
+    np.testing.assert_array_equal(X.toarray(), table.to_numpy())
+
+
+def test_collect_data_reads_csv(tmp_path):
+    tables = {'circus': descriptor_table(3), 'morgan': descriptor_table(4)}
+    for name, (table, y) in tables.items():
+        desc = pd.concat([pd.Series(y, name='logS'), table], axis=1)
+        desc.to_csv(tmp_path / ('logS.' + name + '.csv'), index=False)
+        dump_svmlight_file(table.to_numpy(), y, str(tmp_path / ('logS.' + name + '.svm')), zero_based=False)
+    # the columns before the property are not descriptors
+    desc.insert(0, 'ID', np.arange(len(desc)))
+    desc.to_csv(tmp_path / 'logS.with_id.csv', index=False)
+
+    x_dict, y = collect_data(str(tmp_path), 'R', fmt='csv', n_jobs=2)
+    x_svm, y_svm = collect_data(str(tmp_path), 'R', fmt='svm')
+    assert sorted(x_dict) == ['circus', 'morgan', 'with_id']
+    assert list(y.columns) == ['logS']
+    np.testing.assert_allclose(y['logS'], y_svm['logS'])
+    for name, (table, _) in tables.items():
+        assert x_dict[name].shape == table.shape
+        np.testing.assert_array_equal(x_dict[name], x_svm[name].toarray())
+    np.testing.assert_array_equal(x_dict['with_id'], x_dict['morgan'])
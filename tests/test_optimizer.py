@@ -0,0 +1,222 @@
+import json
+import sys
+
+import numpy as np
+import optuna
+import pandas as pd
+import pytest
+from optuna.distributions import FloatDistribution
+from optuna.trial import create_trial
+from scipy.sparse import csr_matrix
+from sklearn.linear_model import LogisticRegression, Ridge
+from sklearn.model_selection import KFold, cross_val_predict
+
+from doptools.optimizer.optimizer import TopNPatienceCallback, get_preprocessed_descriptors, trials_table
+
+optimizer = sys.modules['doptools.optimizer.optimizer']
+
+
+def descriptor_spaces(n, rows=30, seed=0):
+    rng = np.random.default_rng(seed)
+    return {'desc%d' % i: csr_matrix(rng.integers(0, 3, (rows, 10)).astype(float)) for i in range(n)}
+
+
+@pytest.fixture
+def empty_cache():
+    optimizer._descriptor_cache.clear()
+    yield optimizer._descriptor_cache
+    optimizer._descriptor_cache.clear()
+
+
+def test_descriptor_cache_is_bounded(empty_cache, monkeypatch):
+    monkeypatch.setattr(optimizer, '_descriptor_cache_size', 3)
+    x_dict = descriptor_spaces(5)
+    first = get_preprocessed_descriptors(x_dict, 'desc0', 'maxabs')
+    for desc in ['desc1', 'desc2', 'desc0', 'desc3', 'desc4']:
+        get_preprocessed_descriptors(x_dict, desc, 'maxabs')
+    # desc0 was used recently, so desc1 and desc2 are dropped instead
+    assert [k[0] for k in empty_cache] == ['desc0', 'desc3', 'desc4']
+    assert get_preprocessed_descriptors(x_dict, 'desc0', 'maxabs') is first
+
+
+def test_screening_drops_cached_descriptors(empty_cache, tmp_path):
+    x_dict = descriptor_spaces(4, rows=40)
+    y = pd.DataFrame({'prop': x_dict['desc2'][:, 0].toarray().ravel() + np.linspace(0, 0.1, 40)})
+    optimizer.launch_study(x_dict, y, str(tmp_path), 'SVR', 2, 2, 1, 1, 0, (0, 0), screen=1)
+    screening = pd.read_table(tmp_path / 'descriptors.screening', sep=' ', index_col=0)
+    assert screening.index[0] == 'desc2'
+    assert {k[0] for k in empty_cache} <= {'desc2'}
+
+
+@pytest.mark.parametrize('n_jobs', [1, 3])
+def test_cross_val_fold_predict_matches_sklearn(n_jobs):
+    rng = np.random.default_rng(1)
+    X = csr_matrix(rng.random((60, 8)))
+    Y = X @ rng.random(8)
+    preds, probas = optimizer.cross_val_fold_predict(Ridge(), X, Y, 5, n_jobs=n_jobs)
+    assert probas is None
+    np.testing.assert_allclose(preds, cross_val_predict(Ridge(), X, Y, cv=KFold(5)))
+
+    labels = np.digitize(Y, np.quantile(Y, [1/3, 2/3]))
+    done = []
+    preds, probas = optimizer.cross_val_fold_predict(LogisticRegression(), X, labels, 5, proba=True, n_jobs=n_jobs,
+                                                     callback=lambda mask, p: done.append(mask.sum()))
+    np.testing.assert_array_equal(preds, cross_val_predict(LogisticRegression(), X, labels, cv=KFold(5)))
+    np.testing.assert_allclose(probas, cross_val_predict(LogisticRegression(), X, labels, cv=KFold(5),
+                                                         method='predict_proba'))
+    assert done == [12, 24, 36, 48, 60]
+
+
+def completed_trial(number, value, results):
+    trial = create_trial(params={'x': 0.5}, distributions={'x': FloatDistribution(0, 1)}, value=value,
+                         user_attrs={'results': results})
+    trial.number = number
+    return trial
+
+
+def test_trials_table_matches_rows():
+    trials = [completed_trial(0, 0.5, {'fit_score': 0.6, 'desc': 'a', 'scaling': 'maxabs', 'method': 'SVR',
+                                       'C': 1.5, 'kernel': 'rbf', 'coef0': 0.1}),
+              completed_trial(1, 0.7, {'fit_score': 0.8, 'desc': 'b', 'scaling': 'original', 'method': 'RFR',
+                                       'max_depth': 7, 'n_estimators': 100}),
+              completed_trial(2, 0.2, {'fit_score': 0.3, 'desc': 'a', 'scaling': 'maxabs', 'method': 'SVR',
+                                       'C': 10., 'kernel': 'linear', 'coef0': -1.})]
+    table = trials_table(trials)
+
+    rows = [{'trial': t.number, **t.user_attrs['results'], 'score': t.value} for t in trials]
+    columns = ['trial'] + [c for c in pd.DataFrame(rows).columns if c not in ('trial', 'score')] + ['score']
+    expected = pd.DataFrame(rows, columns=columns).iloc[::-1].reset_index(drop=True)
+    assert list(table.columns) == columns
+    for c in columns:
+        assert [None if pd.isnull(v) else v for v in table[c]] == [None if pd.isnull(v) else v for v in expected[c]]
+    # the integer parameters stay integer despite the trials of the other method
+    assert [type(v) for v in table['max_depth'] if v is not None] == [int]
+
+
+def test_trials_table_empty():
+    assert len(trials_table([])) == 0
+
+
+def rfr_trials():
+    return [completed_trial(i, 0.1*i, {'fit_score': 0.5, 'desc': 'a', 'scaling': 'original', 'method': 'RFR',
+                                       'max_depth': 5 + i, 'max_features': f})
+            for i, f in enumerate(['sqrt', 1.0, 'log2', 0.5])] + \
+           [completed_trial(4, 0.2, {'fit_score': 0.4, 'desc': 'a', 'scaling': 'maxabs', 'method': 'SVR', 'C': 1.})]
+
+
+def test_parquet_table_converts_mixed_columns():
+    table = trials_table(rfr_trials())
+    converted = optimizer._parquet_table(table)
+    assert list(converted['max_features']) == [None, '0.5', 'log2', '1.0', 'sqrt']
+    # the other columns are not changed
+    assert list(converted['max_depth']) == list(table['max_depth'])
+    assert list(table['max_features'])[1:] == [0.5, 'log2', 1.0, 'sqrt']
+
+
+def test_trials_table_written_to_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    table = trials_table(rfr_trials())
+    path = str(tmp_path / 'trials.parquet')
+    optimizer._parquet_table(table).to_parquet(path, index=False)
+    loaded = pd.read_parquet(path)
+    assert list(loaded.columns) == list(table.columns)
+    assert list(loaded['max_features'])[1:] == ['0.5', 'log2', '1.0', 'sqrt']
+    np.testing.assert_allclose(loaded['score'], table['score'])
+
+
+def leaders_stop(values, patience, leaders):
+    # the number of trials after which the study is stopped, by sorting all the trials at each step
+    previous, unchanged = (), 0
+    for i in range(len(values)):
+        if i + 1 < leaders:
+            continue
+        order = sorted(range(i+1), key=lambda j: (-values[j], j))[:leaders]
+        if tuple(order) == previous:
+            unchanged += 1
+        else:
+            unchanged, previous = 0, tuple(order)
+        if unchanged >= patience:
+            return i + 1
+    return len(values)
+
+
+def test_top_n_patience_matches_sorting():
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    values = list(np.random.default_rng(0).random(200))
+    for patience, leaders in [(5, 1), (10, 3), (20, 2)]:
+        study = optuna.create_study(direction='maximize')
+        study.optimize(lambda t: values[t.number], n_trials=len(values),
+                       callbacks=[TopNPatienceCallback(patience, leaders)])
+        assert len(study.trials) == leaders_stop(values, patience, leaders)
+
+
+def test_patience_monitor_takes_the_trials_of_the_workers():
+    storage = optuna.storages.InMemoryStorage()
+    study = optuna.create_study(direction='maximize', storage=storage)
+    study.tell(study.ask(), 9.)
+    study_id = storage.get_study_id_from_name(study.study_name)
+    monitor = optimizer._PatienceMonitor(storage, study_id, (3, 1), interval=0)
+    # a trial left running by a worker does not hold back the following ones
+    running = study.ask()
+    for value in [7., 0.1, 0.2]:
+        study.tell(study.ask(), value)
+    assert not monitor.poll()
+    # the trials of a resumed study finished before the start are not taken
+    assert monitor.callback.n_trials == 3 and monitor.callback.best_value == 7.
+    study.tell(study.ask(), 0.3)
+    assert monitor.poll()
+    study.tell(running, 8.)
+    monitor.poll()
+    assert monitor.callback.best_value == 8. and monitor.callback.steps_since_improvement == 0
+
+
+@pytest.mark.parametrize('task', ['R', 'C'])
+def test_screen_descriptors_ranks_informative_space_first(task, empty_cache):
+    rng = np.random.default_rng(3)
+    x_dict = descriptor_spaces(3, rows=1200, seed=2)
+    informative = x_dict['desc1'].toarray() @ rng.random(10) + 0.1*rng.random(1200)
+    y = pd.DataFrame({'p': (informative > np.median(informative)).astype(int) if task == 'C' else informative})
+    screening = optimizer.screen_descriptors(x_dict, y, task, max_rows=300, n_jobs=2)
+    assert list(screening.index)[0] == 'desc1'
+    assert sorted(screening.index) == sorted(x_dict)
+    assert screening.is_monotonic_decreasing
+    assert screening['desc1'] > 0.7
+    # the subsample is drawn with a fixed seed
+    pd.testing.assert_series_equal(screening, optimizer.screen_descriptors(x_dict, y, task, max_rows=300))
+
+
+def write_trials(outdir):
+    trials = [completed_trial(0, 0.9, {'fit_score': 1., 'desc': 'a', 'scaling': 'scaled', 'method': 'SVR',
+                                       'C': 10., 'kernel': 'rbf', 'coef0': 0.5}),
+              completed_trial(1, 0.95, {'fit_score': 1., 'desc': 'absent', 'scaling': 'maxabs', 'method': 'SVR',
+                                        'C': 1., 'kernel': 'rbf', 'coef0': 0.}),
+              completed_trial(2, 0.8, {'fit_score': 1., 'desc': 'a', 'scaling': 'original', 'method': 'RFR',
+                                       'max_depth': 7, 'max_features': 'sqrt', 'max_samples': 0.5,
+                                       'n_estimators': 100}),
+              completed_trial(3, 0.7, {'fit_score': 1., 'desc': 'b', 'scaling': 'maxabs', 'method': 'SVR',
+                                       'C': 1e12, 'kernel': 'linear', 'coef0': -1.})]
+    trials_table(trials).to_csv(outdir / 'trials.all', sep=' ', index=False, na_rep='None')
+    with open(outdir / 'parameters.json', 'w') as f:
+        json.dump({'desc': 'b', 'scaling': 'original', 'method': 'SVR', 'C': 1., 'kernel': 'poly', 'coef0': 2.}, f)
+
+
+def test_warm_start_params_single_method(tmp_path):
+    write_trials(tmp_path)
+    params = optimizer.warm_start_params([str(tmp_path / 'parameters.json'), str(tmp_path)],
+                                         {'a': None, 'b': None}, 'SVR')
+    assert params == [{'desc_type': 'b', 'scaling': 'original', 'C': 1., 'kernel': 'poly', 'r0': 2.},
+                      # the min-max scaling of the previous versions is replaced by the max-abs scaling
+                      {'desc_type': 'a', 'scaling': 'maxabs', 'C': 10., 'kernel': 'rbf', 'r0': 0.5},
+                      # C is outside of the search space
+                      {'desc_type': 'b', 'scaling': 'maxabs', 'kernel': 'linear', 'r0': -1.}]
+
+
+def test_warm_start_params_several_methods(tmp_path):
+    write_trials(tmp_path)
+    params = optimizer.warm_start_params([str(tmp_path / 'trials.all')], {'a': None, 'b': None}, ['SVR', 'RFR'])
+    assert params[:2] == [{'desc_type': 'a', 'scaling': 'maxabs', 'method': 'SVR',
+                           'SVR_C': 10., 'SVR_kernel': 'rbf', 'SVR_r0': 0.5},
+                          {'desc_type': 'a', 'scaling': 'original', 'method': 'RFR', 'RFR_max_depth': 7,
+                           'RFR_max_features': 'sqrt', 'RFR_max_samples': 0.5, 'RFR_n_estimators': 100}]
+    assert type(params[1]['RFR_max_depth']) is int
+    assert len(params) == 3
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.metrics import (accuracy_score, balanced_accuracy_score, f1_score, matthews_corrcoef,
+                             mean_absolute_error, r2_score, roc_auc_score)
+from sklearn.preprocessing import LabelBinarizer
+
+from doptools.optimizer.optimizer import calculate_scores
+
+
+def make_predictions(task, n_classes=0, n=80, repeats=3, seed=0):
+    rng = np.random.default_rng(seed)
+    if task == 'C':
+        obs = pd.DataFrame({'p': rng.integers(0, n_classes, n)})
+    else:
+        obs = pd.DataFrame({'p': rng.random(n)})
+    pred = pd.DataFrame({'data_index': np.arange(1, n+1), 'p.observed': obs['p']})
+    for r in range(1, repeats+1):
+        if task == 'C':
+            pred['p.predicted.class.repeat'+str(r)] = np.where(rng.random(n) < 0.6, obs['p'],
+                                                                rng.integers(0, n_classes, n))
+            pred['p.predicted_prob.class_0.repeat'+str(r)] = rng.random(n)
+        else:
+            pred['p.predicted.repeat'+str(r)] = obs['p'] + rng.normal(0, 0.3, n)
+    return obs, pred
+
+
+def reference_row(task, x, y):
+    if task == 'R':
+        return {'R2': r2_score(x, y), 'RMSE': np.sqrt(np.mean((x - y)**2)), 'MAE': mean_absolute_error(x, y)}
+    binary = len(set(x)) == 2
+    return {'ROC_AUC': roc_auc_score(x, y) if binary else
+            roc_auc_score(LabelBinarizer().fit_transform(x), LabelBinarizer().fit_transform(y), multi_class='ovr'),
+            'ACC': accuracy_score(x, y),
+            'BAC': balanced_accuracy_score(x, y),
+            'F1': f1_score(x, y) if binary else f1_score(x, y, average='macro'),
+            'MCC': matthews_corrcoef(x, y)}
+
+
+@pytest.mark.parametrize('task,n_classes', [('R', 0), ('C', 2), ('C', 3)])
+def test_calculate_scores_matches_sklearn(task, n_classes):
+    obs, pred = make_predictions(task, n_classes)
+    scores = calculate_scores(task, obs, pred)
+
+    columns = [c for c in pred.columns if 'p.predicted.' in c]
+    consensus = pred[columns].mean(axis=1)
+    if task == 'C':
+        consensus = np.round(consensus)
+    # the consensus comes first, followed by the predictions in reverse order
+    expected = [('p.consensus', consensus)] + [(c, pred[c]) for c in columns[::-1]]
+    assert list(scores['stat']) == [stat for stat, _ in expected]
+    for (_, y), (_, row) in zip(expected, scores.iterrows()):
+        for metric, value in reference_row(task, obs['p'].to_numpy(), y.to_numpy()).items():
+            assert row[metric] == pytest.approx(value)
+
+
+def test_calculate_scores_unknown_task():
+    obs, pred = make_predictions('R')
+    with pytest.raises(ValueError):
+        calculate_scores('X', obs, pred)